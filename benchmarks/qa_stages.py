@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+#
+# Benchmark stages of fMRI quality assurance on synthetic data.
+
+"""
+Time QA stages and record their peak memory on synthetic BOLD runs.
+
+Runs are generated with a brain mask, slow drift, motion parameters
+with a few large displacements, and injected slice spikes, so every
+stage of fmriqa has realistic work to do. FSL is not needed. Each stage
+is timed over several repeats with memory tracing off, then run once
+more with tracemalloc to record its peak memory. Results are saved as
+JSON so that they can be compared between commits using --compare.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess as sub
+import numpy as np
+import nibabel as nib
+
+# number of blocks to read a compressed run in for gz_read_blocks
+n_gz_blocks = 20
+
+# runs shorter than this are too short for spikes to pass the threshold
+min_spike_volumes = 100
+
+# named run sizes (x, y, z, t)
+presets = {
+    "tiny": (32, 32, 16, 60),
+    "small": (64, 64, 64, 200),
+    "medium": (96, 96, 60, 500),
+    "large": (104, 104, 72, 1000),
+}
+
+
+def make_run(
+    run_dir, shape, n_spikes=3, seed=42, compress=False, noise=10, spike_snr=50
+):
+    """
+    Write a synthetic motion-corrected run with mask and motion file.
+
+    Data are stored as int16, as from the scanner. Spikes are spike_snr
+    times the noise standard deviation, in slices from the middle third
+    of the brain, so that they stand out from the other slices. Returns
+    the path to the image and a dict with the volumes and slices of
+    injected spikes.
+    """
+    rng = np.random.default_rng(seed)
+    nx, ny, nz, ntp = shape
+    os.makedirs(run_dir, exist_ok=True)
+
+    # ellipsoid brain mask filling most of the field of view
+    x, y, z = np.ogrid[-1 : 1 : nx * 1j, -1 : 1 : ny * 1j, -1 : 1 : nz * 1j]
+    mask = ((x / 0.8) ** 2 + (y / 0.85) ** 2 + (z / 0.9) ** 2) <= 1
+    baseline = np.where(mask, 1000.0, 20.0)
+    baseline *= 1 + 0.1 * rng.standard_normal(mask.shape)
+    drift = np.linspace(0, 0.02, ntp)
+
+    spike_vols = rng.choice(np.arange(5, ntp - 5), n_spikes, replace=False)
+    spike_slices = rng.integers(nz // 3, nz - nz // 3, n_spikes)
+    spikes = dict(zip(spike_vols.tolist(), spike_slices.tolist()))
+
+    data = np.empty(shape, dtype=np.int16)
+    for t in range(ntp):
+        vol = baseline * (1 + drift[t])
+        vol += rng.normal(0, noise, mask.shape).astype(np.float32)
+        if t in spikes:
+            vol[:, :, spikes[t]] += spike_snr * noise * mask[:, :, spikes[t]]
+        data[..., t] = np.clip(vol, 0, np.iinfo(np.int16).max)
+
+    ext = ".nii.gz" if compress else ".nii"
+    infile = os.path.join(run_dir, "bold_mcf" + ext)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    nib.Nifti1Image(data, affine).to_filename(infile)
+    del data
+    maskfile = os.path.join(run_dir, "bold_mcf_brain_mask" + ext)
+    nib.Nifti1Image(mask.astype(np.int16), affine).to_filename(maskfile)
+
+    # small jitter with a few large head movements
+    motpars = rng.normal(0, 0.02, (ntp, 6))
+    motpars[:, :3] *= 0.01
+    for t in rng.choice(np.arange(1, ntp), 3, replace=False):
+        motpars[t:, 3:] += rng.normal(0, 0.5, 3)
+    np.savetxt(os.path.join(run_dir, "bold_mcf.par"), motpars)
+
+    truth = {
+        "spike_volumes": sorted(spikes),
+        "spike_slices": [spikes[t] for t in sorted(spikes)],
+    }
+    return infile, truth
+
+
+def measure(func, repeat=3, trace=True):
+    """Best wall time over repeats and peak traced memory of a function."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if trace:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        "time_s": min(times),
+        "peak_mb": None if peak is None else peak / 1024 ** 2,
+    }
+
+
+def read_blocks(infile, n_blocks):
+    """Read all volumes of a run in a number of blocks, in order."""
+    from fprep import image
+
+    img = image.load(infile)
+    source = image.get_source(img)
+    ntp = img.shape[3]
+    size = -(-ntp // n_blocks)
+    for start in range(0, ntp, size):
+        image.read_volumes(source, start, min(start + size, ntp))
+
+
+class StageData:
+    """
+    Inputs shared by QA stages, made when first needed.
+
+    Large inputs are released once no remaining stage needs them, so
+    that at most a few copies of a large run are in memory at once.
+    """
+
+    # inputs that each input is made from
+    deps = {
+        "imgdata": [],
+        "brain": ["imgdata"],
+        "nonbrain": ["imgdata"],
+        "voxmean": ["imgdata"],
+        "gzfile": ["imgdata"],
+        "zscore": ["brain"],
+        "AAZ": ["zscore"],
+    }
+
+    def __init__(self, infile):
+        from fprep import image
+
+        self.infile = infile
+        self.run_dir = os.path.dirname(infile)
+        self.img = image.load(infile)
+        self.cache = {}
+
+    def get(self, name):
+        """Get an input, making it if needed."""
+        if name not in self.cache:
+            self.cache[name] = getattr(self, "make_" + name)()
+        return self.cache[name]
+
+    def release(self, needed):
+        """Release inputs that are not needed to make the needed inputs."""
+        keep = set()
+        stack = list(needed)
+        while stack:
+            name = stack.pop()
+            if name in keep:
+                continue
+            keep.add(name)
+            if name not in self.cache:
+                stack.extend(self.deps[name])
+        for name in list(self.cache):
+            if name not in keep:
+                del self.cache[name]
+
+    def make_imgdata(self):
+        from fprep import image
+
+        return np.array(image.get_data(self.img))
+
+    def make_brain(self):
+        return self.get("imgdata")[self.maskvox].astype(np.float64)
+
+    def make_nonbrain(self):
+        return self.get("imgdata")[self.nonmaskvox]
+
+    def make_voxmean(self):
+        return np.mean(self.get("imgdata"), 3, dtype=np.float64)
+
+    def make_gzfile(self):
+        # compressed copy of the run, to check that reading a compressed
+        # file in blocks takes about as long as reading it at once
+        if self.infile.endswith(".gz"):
+            return self.infile
+        gzfile = os.path.join(self.run_dir, "bold_mcf_gz.nii.gz")
+        img = nib.Nifti1Image(self.get("imgdata"), self.img.affine, self.img.header)
+        img.to_filename(gzfile)
+        return gzfile
+
+    def make_zscore(self):
+        from fprep import qa
+
+        return qa.detrend_zscore(self.get("brain").copy())
+
+    def make_AAZ(self):
+        from fprep import qa
+
+        shape = self.img.shape
+        zscore = self.get("zscore")
+        return qa.slice_aaz(zscore, self.maskvox[2], shape[2], shape[0] * shape[1])
+
+
+def stages(infile, qa_dir, max_memory):
+    """
+    Functions to benchmark for one run, with their shared inputs.
+
+    Returns a dict of functions, the inputs that each one needs, and
+    the StageData that holds the inputs.
+    """
+    from fprep import qa
+    from fprep import image
+    from fprep.fmriqa import fmriqa
+
+    run_dir = os.path.dirname(infile)
+    maskfile = infile.replace("mcf.nii", "mcf_brain_mask.nii")
+    motfile = os.path.join(run_dir, "bold_mcf.par")
+
+    data = StageData(infile)
+    maskdata = image.get_data(image.load(maskfile))
+    maskvox = np.where(maskdata > 0)
+    slice_order = np.argsort(maskvox[2], kind="stable")
+    data.maskvox = tuple(ind[slice_order] for ind in maskvox)
+    data.nonmaskvox = np.where(maskdata == 0)
+    motpars = np.loadtxt(motfile)
+    nslices = data.img.shape[2]
+    slice_size = data.img.shape[0] * data.img.shape[1]
+    get = data.get
+
+    def run_fmriqa(**kwargs):
+        fmriqa(
+            infile,
+            2.0,
+            outdir=qa_dir,
+            maskfile=maskfile,
+            motfile=motfile,
+            use_cache=False,
+            **kwargs
+        )
+
+    # stages run in this order; stages that use the whole run come
+    # first, so that it can be released before the brain data are used
+    funcs = {
+        "load": lambda: np.array(image.get_data(image.load(infile))),
+        "gz_read": lambda: read_blocks(get("gzfile"), 1),
+        "gz_read_blocks": lambda: read_blocks(get("gzfile"), n_gz_blocks),
+        "compute_fd": lambda: qa.compute_fd(motpars),
+        "voxel_stats": lambda: (
+            np.mean(get("imgdata"), 3, dtype=np.float64),
+            np.std(get("imgdata"), 3, dtype=np.float64),
+        ),
+        "mk_slice_mosaic": lambda: qa.mk_slice_mosaic(
+            get("voxmean"), io.BytesIO(), "Image mean", contourdata=maskdata
+        ),
+        "MAD": lambda: qa.MAD(get("brain"), axis=0),
+        "mask_stats": lambda: qa.mask_stats(get("brain"), get("nonbrain")),
+        "detrend_zscore": lambda: qa.detrend_zscore(get("brain").copy()),
+        "slice_aaz": lambda: qa.slice_aaz(
+            get("zscore"), data.maskvox[2], nslices, slice_size
+        ),
+        "jackknife_z": lambda: qa.jackknife_z(get("AAZ")),
+        "fmriqa_stats": lambda: run_fmriqa(plot_data=False),
+        "fmriqa_chunked": lambda: run_fmriqa(plot_data=False, max_memory=max_memory),
+        "fmriqa_report": lambda: run_fmriqa(plot_data=True),
+    }
+    needs = {
+        "gz_read": ["gzfile"],
+        "gz_read_blocks": ["gzfile"],
+        "voxel_stats": ["imgdata"],
+        "mk_slice_mosaic": ["voxmean"],
+        "MAD": ["brain"],
+        "mask_stats": ["brain", "nonbrain"],
+        "detrend_zscore": ["brain"],
+        "slice_aaz": ["zscore"],
+        "jackknife_z": ["AAZ"],
+    }
+    return funcs, needs, data
+
+
+def git_commit():
+    """Current commit of the code being benchmarked, if available."""
+    try:
+        out = sub.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=sub.PIPE,
+            stderr=sub.DEVNULL,
+            universal_newlines=True,
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(results, previous):
+    """Print the ratio of times and peak memory to previous results."""
+    old = {(r["size"], r["stage"]): r for r in previous["results"]}
+    print("\n%-20s %-16s %8s %8s" % ("size", "stage", "time", "memory"))
+    for res in results:
+        key = (res["size"], res["stage"])
+        if key not in old:
+            continue
+        time_ratio = res["time_s"] / old[key]["time_s"]
+        if res["peak_mb"] and old[key]["peak_mb"]:
+            mem_ratio = "%7.2fx" % (res["peak_mb"] / old[key]["peak_mb"])
+        else:
+            mem_ratio = "%8s" % "-"
+        print("%-20s %-16s %7.2fx %s" % (key[0], key[1], time_ratio, mem_ratio))
+
+
+def parse_size(text):
+    """Parse a preset name or XxYxZxT size."""
+    if text in presets:
+        return text, presets[text]
+    try:
+        shape = tuple(int(n) for n in text.lower().split("x"))
+    except ValueError:
+        shape = ()
+    if len(shape) != 4:
+        raise argparse.ArgumentTypeError(
+            "size must be one of %s or XxYxZxT" % ", ".join(presets)
+        )
+    return text, shape
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark QA stages on synthetic BOLD data."
+    )
+    parser.add_argument(
+        "--size",
+        type=parse_size,
+        action="append",
+        help="run size; preset (%s) or XxYxZxT (default: small)" % ", ".join(presets),
+    )
+    parser.add_argument(
+        "--stage", action="append", help="stage to run (default: all stages)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip peak memory measurement"
+    )
+    parser.add_argument(
+        "--max-memory", type=int, default=200, help="MB limit for chunked QA"
+    )
+    parser.add_argument("--compress", action="store_true", help="write .nii.gz runs")
+    parser.add_argument("--work-dir", help="directory for synthetic runs")
+    parser.add_argument("--output", help="save results to a JSON file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    sizes = args.size if args.size else [parse_size("small")]
+    work_dir = args.work_dir
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix="fprep_bench_")
+
+    results = []
+    try:
+        for name, shape in sizes:
+            print("size %s %s" % (name, "x".join(str(n) for n in shape)))
+            run_dir = os.path.join(work_dir, "x".join(str(n) for n in shape))
+            infile, truth = make_run(run_dir, shape, compress=args.compress)
+            out_dir = os.path.join(run_dir, "out")
+            os.makedirs(out_dir, exist_ok=True)
+            funcs, needs, data = stages(infile, out_dir, args.max_memory)
+            if args.stage:
+                unknown = set(args.stage) - set(funcs)
+                if unknown:
+                    parser.error("unknown stage: %s" % ", ".join(sorted(unknown)))
+                funcs = {stage: funcs[stage] for stage in args.stage}
+
+            stage_names = list(funcs)
+            for i, (stage, func) in enumerate(funcs.items()):
+                # make inputs before timing, and free those that no later
+                # stage needs
+                for need in needs.get(stage, []):
+                    data.get(need)
+                later = [
+                    need
+                    for later_stage in stage_names[i:]
+                    for need in needs.get(later_stage, [])
+                ]
+                data.release(later)
+                res = measure(func, args.repeat, not args.no_memory)
+                res.update({"size": name, "shape": shape, "stage": stage})
+                peak = "-" if res["peak_mb"] is None else "%.1f MB" % res["peak_mb"]
+                print("  %-16s %9.4f s %12s" % (stage, res["time_s"], peak))
+                results.append(res)
+            data.release([])
+            del data
+
+            # check that reading a compressed run in blocks is not
+            # much slower than reading it at once
+            times = {r["stage"]: r["time_s"] for r in results if r["size"] == name}
+            if "gz_read" in times and "gz_read_blocks" in times:
+                ratio = times["gz_read_blocks"] / times["gz_read"]
+                if ratio > 2:
+                    print(
+                        "  warning: reading a compressed run in %d blocks "
+                        "is %.1f times slower than reading it at once"
+                        % (n_gz_blocks, ratio)
+                    )
+
+            # check that QA found the injected spikes; the Z-score of a
+            # single volume is limited by the length of the run, so short
+            # runs cannot reach the AJKZ threshold
+            ran_qa = any(stage.startswith("fmriqa") for stage in funcs)
+            if ran_qa and shape[3] >= min_spike_volumes:
+                spike_file = os.path.join(out_dir, "QA", "spikes.txt")
+                spikes = []
+                if os.path.exists(spike_file):
+                    spikes = np.loadtxt(spike_file, ndmin=1).astype(int).tolist()
+                if sorted(spikes) != truth["spike_volumes"]:
+                    print(
+                        "  warning: detected spikes %s do not match injected "
+                        "spikes %s" % (sorted(spikes), truth["spike_volumes"])
+                    )
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir)
+
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Check interpreter startup cost of fPrep entry points.
+
+"""
+Measure import time of fPrep modules using python -X importtime.
+
+Each module is imported in a fresh interpreter. The benchmark fails if
+the cumulative import time exceeds its budget or if a module pulls in a
+heavy dependency that it should only load on the code paths that use it.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess as sub
+
+# module: (budget in ms, dependencies that must not be imported)
+targets = {
+    "fprep.subjutil": (
+        150,
+        ["numpy", "pkg_resources", "nibabel", "matplotlib", "pydicom"],
+    ),
+    "fprep.heuristic": (150, ["numpy", "pkg_resources", "pydicom"]),
+    "fprep.fmriqa": (
+        1500,
+        ["matplotlib", "statsmodels", "sklearn", "reportlab", "pkg_resources"],
+    ),
+    "fprep.imagemath": (1000, ["scipy.ndimage", "matplotlib", "pkg_resources"]),
+}
+
+
+def import_times(module, python=sys.executable):
+    """Cumulative import time in microseconds for each imported module."""
+    cmd = [python, "-X", "importtime", "-c", "import %s" % module]
+    p = sub.run(cmd, stdout=sub.PIPE, stderr=sub.PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError("Importing %s failed:\n%s" % (module, p.stderr))
+
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # header line
+            continue
+        name = fields[2].strip()
+        times[name] = cumulative
+    return times
+
+
+def check_module(module, budget, forbidden, repeat=3):
+    """Check the import time and dependencies of a module."""
+    # import time varies from run to run; take the best
+    best = None
+    for i in range(repeat):
+        times = import_times(module)
+        if best is None or times[module] < best[module]:
+            best = times
+
+    total_ms = best[module] / 1000
+    loaded = [name for name in forbidden if name in best]
+    result = {
+        "module": module,
+        "time_ms": total_ms,
+        "budget_ms": budget,
+        "heavy_imports": loaded,
+        "passed": total_ms <= budget and not loaded,
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check import time of fPrep entry points."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=float(os.environ.get("FPREP_STARTUP_SCALE", 1)),
+        help="multiply all time budgets by this factor (for slow machines)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module")
+    parser.add_argument("--output", help="save results to a JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for module, (budget, forbidden) in targets.items():
+        res = check_module(module, budget * args.scale, forbidden, args.repeat)
+        status = "ok" if res["passed"] else "FAIL"
+        print(
+            "%-20s %8.1f ms (budget %6.0f ms) %s"
+            % (module, res["time_ms"], res["budget_ms"], status)
+        )
+        if res["heavy_imports"]:
+            print("    imports: %s" % ", ".join(res["heavy_imports"]))
+        results.append(res)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not all(res["passed"] for res in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,18 @@
 # Generate regions of interest from FreeSurfer output.
 
 from fprep.subjutil import *
+from fprep import roi
+import os
 
 
 parser = SubjParser()
 parser.add_argument("--reg", "-r", help="registration type", default="bbreg")
+parser.add_argument(
+    "--store",
+    action="store_true",
+    help="save ROIs in a single file, rois.npz, instead of individual "
+    "masks (use fprep-roi-export to write masks)",
+)
 args = parser.parse_args()
 
 sp = SubjPath(args.subject, args.study_dir)
@@ -15,6 +23,18 @@ log = sp.init_log("anatrois", "preproc", args)
 log.start()
 data_dir = sp.path("anatomy", args.reg, "data")
 parc_file = impath(data_dir, "aparc+aseg")
-log.run("roi_freesurfer.sh %s %s" % (parc_file, data_dir))
-log.run("croi_freesurfer.sh %s %s" % (parc_file, data_dir))
+if args.store:
+    log.run(
+        "fprep-roi --store %s %s" % (parc_file, data_dir),
+        inputs=[parc_file],
+        outputs=[os.path.join(data_dir, "rois.npz")],
+    )
+else:
+    roi_files = [impath(data_dir, name) for name in roi.standard_rois]
+    roi_files += [impath(data_dir, name) for name in roi.cortical_rois]
+    log.run(
+        "fprep-roi %s %s" % (parc_file, data_dir),
+        inputs=[parc_file],
+        outputs=[impath(data_dir, "parcels")] + roi_files,
+    )
 log.finish()
@@ -42,44 +42,64 @@ for i in range(len(src_names)):
         continue
 
     # convert to Nifti
-    log.run("mri_convert %s %s" % (src_file, dest_file))
+    log.submit(
+        "mri_convert %s %s" % (src_file, dest_file),
+        inputs=[src_file],
+        outputs=[dest_file],
+    )
 
     # fix orientation
-    log.run("fslreorient2std %s %s" % (dest_file, dest_file))
+    log.submit(
+        "fslreorient2std %s %s" % (dest_file, dest_file),
+        inputs=[dest_file],
+        outputs=[dest_file],
+    )
 
 # use the FS parcelation to get an improved brain extraction
 
 # mask for original brain extraction
 brain_auto = impath(dest, "orig_brain_auto")
 mask_auto = impath(dest, "brainmask_auto")
-log.run("fslmaths %s -thr 0.5 -bin %s" % (brain_auto, mask_auto))
+log.submit(
+    "fprep-math %s -thr 0.5 -bin %s" % (brain_auto, mask_auto),
+    inputs=[brain_auto],
+    outputs=[mask_auto],
+)
 
 # smooth and threshold the identified tissues; fill any remaining holes
 parcel = impath(dest, "aparc+aseg")
 mask_surf = impath(dest, "brainmask_surf")
-log.run("fslmaths %s -thr 0.5 -bin -s 0.25 -bin -fillh26 %s" % (parcel, mask_surf))
+log.submit(
+    "fslmaths %s -thr 0.5 -bin -s 0.25 -bin -fillh26 %s" % (parcel, mask_surf),
+    inputs=[parcel],
+    outputs=[mask_surf],
+)
 
 # take intersection with original mask (assumed to include all cortex,
-# so don't want to extend beyond that)
+# so don't want to extend beyond that); create a brain-extracted image
+# based on the orig image from freesurfer (later images have various
+# normalization things done that won't match the MNI template as well)
 mask = impath(dest, "brainmask")
-log.run("fslmaths %s -mul %s -bin %s" % (mask_surf, mask_auto, mask))
-
-# create a brain-extracted image based on the orig image from
-# freesurfer (later images have various normalization things done that
-# won't match the MNI template as well)
 orig = impath(dest, "orig")
 output = impath(dest, "orig_brain")
-log.run("fslmaths %s -mas %s %s" % (orig, mask, output))
-
-# cortex
-log.run("fslmaths %s -thr 1000 -bin %s" % (parcel, impath(dest, "ctx")))
+log.submit(
+    "fprep-math %s -mul %s -bin %s , %s -mas %s %s"
+    % (mask_surf, mask_auto, mask, orig, mask, output),
+    inputs=[mask_surf, mask_auto, orig],
+    outputs=[mask, output],
+)
 
-# cerebral white matter
-log.run("fslmaths %s -thr 2 -uthr 2 -bin %s" % (parcel, impath(dest, "l_wm")))
-log.run("fslmaths %s -thr 41 -uthr 41 -bin %s" % (parcel, impath(dest, "r_wm")))
-log.run(
-    "fslmaths %s -add %s -bin %s"
-    % (impath(dest, "l_wm"), impath(dest, "r_wm"), impath(dest, "wm"))
+# cortex and cerebral white matter
+ctx = impath(dest, "ctx")
+l_wm = impath(dest, "l_wm")
+r_wm = impath(dest, "r_wm")
+wm = impath(dest, "wm")
+log.submit(
+    "fprep-math %s -thr 1000 -bin %s , %s -thr 2 -uthr 2 -bin %s , "
+    "%s -thr 41 -uthr 41 -bin %s , %s -add %s -bin %s"
+    % (parcel, ctx, parcel, l_wm, parcel, r_wm, l_wm, r_wm, wm),
+    inputs=[parcel],
+    outputs=[ctx, l_wm, r_wm, wm],
 )
 
 log.finish()
@@ -111,36 +111,51 @@ cmd = (
         out_base,
     )
 )
-log.run(cmd)
+epireg_inv = os.path.join(fm_dir, "epireg_inv.mat")
+log.run(
+    cmd,
+    inputs=[fmap, fmapmag, fmapmagbrain, wm_mask, epi_input, highres, highres_brain],
+    outputs=[epireg_inv],
+)
 
 # convert shift map to a warp
 shift = impath(fm_dir, "epireg_fieldmaprads2epi_shift")
 warp = impath(fm_dir, "epireg_epi_warp")
+# (the shift map is removed unless keeping intermediate files, so
+# depend on the transform from the same epi_reg run instead)
 log.run(
     "convertwarp -r %s -s %s -o %s --shiftdir=%s --relout"
-    % (epi_input, shift, warp, args.pedir)
+    % (epi_input, shift, warp, args.pedir),
+    inputs=[epi_input, epireg_inv],
+    outputs=[warp],
 )
 
 # unwarp the average run image for registration purposes
 epi_unwarped = impath(fm_dir, "epireg_epi_unwarped")
 log.run(
     "applywarp -i %s -r %s -o %s -w %s --interp=spline --rel"
-    % (epi_input, epi_input, epi_unwarped, warp)
+    % (epi_input, epi_input, epi_unwarped, warp),
+    inputs=[epi_input, warp],
+    outputs=[epi_unwarped],
 )
 
 # transform the anatomical brain mask into functional space
 mask_reg = impath(fm_dir, "brainmask")
 log.run(
     "flirt -in %s -ref %s -applyxfm -init %s -out %s -interp nearestneighbour"
-    % (highres_mask, epi_unwarped, os.path.join(fm_dir, "epireg_inv.mat"), mask_reg)
+    % (highres_mask, epi_unwarped, epireg_inv, mask_reg),
+    inputs=[highres_mask, epi_unwarped, epireg_inv],
+    outputs=[mask_reg],
 )
 
 # dilate to make a tighter brain extraction than the liberal one
-# originally used for the functionals
-log.run("fslmaths %s -kernel sphere 3 -dilD %s" % (mask_reg, mask_reg))
-
-# mask the unwarped epi
-log.run("fslmaths %s -mas %s %s" % (epi_unwarped, mask_reg, epi_output))
+# originally used for the functionals, and mask the unwarped epi
+log.run(
+    "fprep-math %s -kernel sphere 3 -dilD %s , %s -mas %s %s"
+    % (mask_reg, mask_reg, epi_unwarped, mask_reg, epi_output),
+    inputs=[mask_reg, epi_unwarped],
+    outputs=[mask_reg, epi_output],
+)
 
 if not args.keep:
     log.run(
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#
+# Extract ROI time series and tSNR from registered functional runs.
+
+from fprep.subjutil import *
+import os
+
+s = """Extract ROI time series and tSNR from registered functional runs.
+
+Uses FreeSurfer labels transformed to functional space (by
+transform_anat2func.py) and runs registered to the reference run (by
+reg_unwarp_bold_run.py). Statistics for all ROIs are calculated in one
+pass over each run, and runs are processed in parallel. Results are
+saved in BOLD/antsreg/roi/[run]_roi.npz.
+"""
+
+parser = SubjParser(description=s, raw=True)
+parser.add_argument(
+    "--labels",
+    "-l",
+    default="aparc+aseg",
+    help="label image in anatomy/bbreg/data (default: aparc+aseg)",
+)
+args = parser.parse_args()
+
+sp = SubjPath(args.subject, args.study_dir)
+log = sp.init_log("roits", "preproc", args)
+log.start()
+
+parc_file = sp.image_path("anatomy", "bbreg", "data", args.labels)
+reg_data = sp.path("bold", "antsreg", "data")
+out_dir = sp.path("bold", "antsreg", "roi")
+runs = [impath(reg_data, os.path.basename(d)) for d in sp.bold_dirs()]
+runs = [run for run in runs if os.path.exists(run)]
+if not runs:
+    raise IOError("No registered runs found in %s" % reg_data)
+
+cmd = ["fprep-roi-extract", parc_file] + runs + ["-o", out_dir]
+if args.threads is not None:
+    cmd += ["-n", args.threads]
+log.run(
+    cmd,
+    inputs=[parc_file] + runs,
+    outputs=[os.path.join(out_dir, imname(run) + "_roi.npz") for run in runs],
+)
+log.finish()
@@ -89,19 +89,25 @@ else
     imcp fix fix_cor
 fi
 
-# calculate mask
+# calculate mask thresholds
+thresh=()
 for file in fix_cor mov_cor_reg; do
     int_2_98=$(fslstats $file -p 2 -p 98)
     int2=$(echo "${int_2_98}" | awk '{print $1}')
     int98=$(echo "${int_2_98}" | awk '{print $2}')
-    thresh=$(python -c "print(${int2} + 0.1 * (${int98} - ${int2}))")
-    fslmaths "${file}" -thr "${thresh}" -bin "${file}_mask"
+    thresh+=("$(python -c "print(${int2} + 0.1 * (${int98} - ${int2}))")")
 done
-fslmaths fix_cor_mask -mul mov_cor_reg_mask mask
+
+# make the mask and apply it to both images, reading each image once
+fprep-math \
+    fix_cor -thr "${thresh[0]}" -bin fix_cor_mask , \
+    mov_cor_reg -thr "${thresh[1]}" -bin mov_cor_reg_mask , \
+    fix_cor_mask -mul mov_cor_reg_mask mask , \
+    fix_cor -mas mask fix_cor_thresh , \
+    mov_cor_reg -mas mask mov_cor_reg_thresh
 
 # normalize global intensity between images so they are equally weighted
 for file in fix_cor mov_cor_reg; do
-    fslmaths "${file}" -mas mask "${file}_thresh"
     fslmaths "${file}_thresh" -inm 1000 "${file}_norm"
 done
 
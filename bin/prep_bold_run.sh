@@ -88,9 +88,8 @@ N4BiasFieldCorrection -d 3 -i bold_mcf_avg.nii.gz -o bold_mcf_avg_cor.nii.gz
 bet bold_mcf_avg_cor bold_mcf_brain -m
 
 # QA/identify volumes to scrub
-tr=$(fslval bold pixdim4)
 cp bold_cor_mcf.par bold_mcf.par
-fmriqa.py bold_mcf.nii.gz "${tr}"
+fmriqa.py bold_mcf.nii.gz --tr-image bold.nii.gz
 
 # remove intermediate files. Just need motion correction parameters, a
 # good average image for registration, and the estimated bias field
@@ -74,7 +74,11 @@ if not os.path.exists(highres_mask):
 
 # correct bias of magnitude image
 mag_cor = sp.image_path("fieldmap", "fieldmap_mag_cor{}".format(args.fieldmap))
-log.run("N4BiasFieldCorrection -d 3 -i {} -o {}".format(mag, mag_cor))
+log.run(
+    "N4BiasFieldCorrection -d 3 -i {} -o {}".format(mag, mag_cor),
+    inputs=[mag],
+    outputs=[mag_cor],
+)
 
 # register the corrected magnitude image to the corrected highres
 xfm_base = os.path.join(reg_xfm, "fieldmap{}-orig{}_".format(args.fieldmap, args.anat))
@@ -82,7 +86,9 @@ xfm_file = xfm_base + "0GenericAffine.mat"
 log.run(
     "antsRegistration -d 3 -r [{ref},{mov},1] -t Rigid[0.1] -m MI[{ref},{mov},1,32,Regular,0.25] -c [1000x500x250x100,1e-6,10] -f 8x4x2x1 -s 3x2x1x0vox -n BSpline -w [0.005,0.995] -o {xfm}".format(
         ref=highres_brain, mov=mag_cor, xfm=xfm_base
-    )
+    ),
+    inputs=[highres_brain, mag_cor],
+    outputs=[xfm_file],
 )
 
 # use the highres brain mask to mask the magnitude image
@@ -95,16 +101,24 @@ mag_cor_brain = sp.image_path(
 log.run(
     "antsApplyTransforms -i {} -o {} -r {} -t [{},1] -n NearestNeighbor".format(
         highres_mask, mask_reg, mag, xfm_file
-    )
+    ),
+    inputs=[highres_mask, mag, xfm_file],
+    outputs=[mask_reg],
+)
+log.run(
+    "fprep-math {mask} -fillh26 {mask} , {} -mas {mask} {} , {} -mas {mask} {}".format(
+        mag, mag_brain, mag_cor, mag_cor_brain, mask=mask_reg
+    ),
+    inputs=[mask_reg, mag, mag_cor],
+    outputs=[mask_reg, mag_brain, mag_cor_brain],
 )
-log.run("fslmaths {mask} -fillh26 {mask}".format(mask=mask_reg))
-log.run("fslmaths {} -mas {} {}".format(mag, mask_reg, mag_brain))
-log.run("fslmaths {} -mas {} {}".format(mag_cor, mask_reg, mag_cor_brain))
 
 # convert the phase image to radians
 rads = sp.image_path("fieldmap", "fieldmap_rads_brain{}".format(args.fieldmap))
 log.run(
-    "fsl_prepare_fieldmap SIEMENS {} {} {} {}".format(phase, mag_brain, rads, args.dte)
+    "fsl_prepare_fieldmap SIEMENS {} {} {} {}".format(phase, mag_brain, rads, args.dte),
+    inputs=[phase, mag_brain],
+    outputs=[rads],
 )
 
 log.finish()
@@ -74,38 +74,53 @@ for image, label in zip(images, labels):
         # just transform to the space of the original highres
         # scan. Will add a "1" to all images to distinguish from the
         # freesurfer-space image
-        log.run(
+        log.submit(
             "antsApplyTransforms -i {} -o {} -r {} -t {} -n {}".format(
-                impath(dest, image),
+                src_image,
                 impath(dest, image + "1"),
                 impath(dest, "highres"),
                 o2h,
                 interp,
-            )
+            ),
+            inputs=[src_image, impath(dest, "highres"), o2h],
+            outputs=[impath(dest, image + "1")],
+            threads=2,
         )
     else:
         # transform to the space of the moving image
-        log.run(
+        log.submit(
             "antsApplyTransforms -i {} -o {} -r {} -t [{},1] -t {} -t {} -n {}".format(
-                impath(dest, image),
+                src_image,
                 impath(dest, image + movnum),
                 impath(dest, "highres" + movnum),
                 h2h_affine,
                 h2h_warp,
                 o2h,
                 interp,
-            )
+            ),
+            inputs=[
+                src_image,
+                impath(dest, "highres" + movnum),
+                h2h_affine,
+                h2h_warp,
+                o2h,
+            ],
+            outputs=[impath(dest, image + movnum)],
+            threads=2,
         )
 
         # transform to the space of the fixed image
-        log.run(
+        log.submit(
             "antsApplyTransforms -i {} -o {} -r {} -t {} -n {}".format(
-                impath(dest, image),
+                src_image,
                 impath(dest, image + fixnum),
                 impath(dest, "highres" + fixnum),
                 o2h,
                 interp,
-            )
+            ),
+            inputs=[src_image, impath(dest, "highres" + fixnum), o2h],
+            outputs=[impath(dest, image + fixnum)],
+            threads=2,
         )
 
 log.finish()
@@ -25,8 +25,15 @@ parser.add_argument(
     help="use only linear transforms (default is to use nonlinear SyN transform)",
     action="store_true",
 )
-parser.add_argument("-k", "--keep", help="keep intermediate files", action="store_true")
+parser.add_argument(
+    "-k",
+    "--keep",
+    help="keep intermediate files (always kept with --incremental, so that "
+    "they do not have to be remade)",
+    action="store_true",
+)
 args = parser.parse_args()
+keep = args.keep or args.incremental
 
 sp = SubjPath(args.subject, args.study_dir)
 log = sp.init_log("regunwarp_%s" % args.runid, "preproc", args)
@@ -66,10 +73,20 @@ if args.refrun == args.runid:
     # just motion correct and unwarp
     log.run(
         "applywarp -i %s -r %s -o %s --premat=%s -w %s --interp=spline --rel --paddingsize=1"
-        % (bold, refvol, bold_reg, mcf_file, warp_file)
+        % (bold, refvol, bold_reg, mcf_file, warp_file),
+        inputs=[bold, refvol, mcf_file, warp_file],
+        outputs=[bold_reg],
+    )
+    log.run(
+        "cp %s %s" % (refvol, impath(reg_data, "refvol")),
+        inputs=[refvol],
+        outputs=[impath(reg_data, "refvol")],
+    )
+    log.run(
+        "cp %s %s" % (mask, impath(reg_data, "mask")),
+        inputs=[mask],
+        outputs=[impath(reg_data, "mask")],
     )
-    log.run("cp %s %s" % (refvol, impath(reg_data, "refvol")))
-    log.run("cp %s %s" % (mask, impath(reg_data, "mask")))
 else:
     bold_init = impath(srcdir, "bold_reg_init")
     bold_init_avg = impath(srcdir, "bold_reg_init_avg")
@@ -78,35 +95,58 @@ else:
     xfm_base = os.path.join(reg_xfm, "%s-refvol_" % args.runid)
     itk_file = xfm_base + "0GenericAffine.mat"
     txt_file = xfm_base + "0GenericAffine.txt"
-    if not os.path.exists(itk_file):
-        if args.linear:
-            tflag = "a"  # rigid + affine
-        else:
-            tflag = "s"  # rigid + affine + deformable syn
+    warp = xfm_base + "1Warp.nii.gz"
+    if args.linear:
+        tflag = "a"  # rigid + affine
+        xfm_files = [itk_file]
+    else:
+        tflag = "s"  # rigid + affine + deformable syn
+        xfm_files = [itk_file, warp]
 
+    # without incremental mode, an existing registration is reused, since
+    # it is slow to run
+    if args.incremental or not os.path.exists(itk_file):
         log.run(
             "antsRegistrationSyN.sh -d 3 -m {mov} -f {fix} -o {out} -n {nitk} -t {transform}".format(
                 mov=srcvol, fix=refvol, out=xfm_base, nitk=nitk, transform=tflag
-            )
+            ),
+            inputs=[srcvol, refvol],
+            outputs=xfm_files,
         )
 
     # convert the affine part to FSL format
     reg_file = os.path.join(reg_xfm, "%s-refvol.mat" % args.runid)
-    log.run("ConvertTransformFile 3 %s %s" % (itk_file, txt_file))
+    log.run(
+        "ConvertTransformFile 3 %s %s" % (itk_file, txt_file),
+        inputs=[itk_file],
+        outputs=[txt_file],
+    )
     log.run(
         "c3d_affine_tool -itk %s -ref %s -src %s -ras2fsl -o %s"
-        % (txt_file, refvol, srcvol, reg_file)
+        % (txt_file, refvol, srcvol, reg_file),
+        inputs=[txt_file, refvol, srcvol],
+        outputs=[reg_file],
     )
 
     # apply motion correction, unwarping, and affine co-registration
     log.run(
         "applywarp -i %s -r %s -o %s --premat=%s -w %s --postmat=%s --interp=spline --rel --paddingsize=1"
-        % (bold, refvol, bold_init, mcf_file, warp_file, reg_file)
+        % (bold, refvol, bold_init, mcf_file, warp_file, reg_file),
+        inputs=[bold, refvol, mcf_file, warp_file, reg_file],
+        outputs=[bold_init],
+    )
+    log.run(
+        "fprep-math %s -Tmean %s" % (bold_init, bold_init_avg),
+        inputs=[bold_init],
+        outputs=[bold_init_avg],
     )
-    log.run("fslmaths %s -Tmean %s" % (bold_init, bold_init_avg))
 
     if args.linear:
-        log.run("cp {} {}".format(bold_init, bold_reg))
+        log.run(
+            "cp {} {}".format(bold_init, bold_reg),
+            inputs=[bold_init],
+            outputs=[bold_reg],
+        )
     else:
         # apply co-registration warp. Tried to figure out how to do this
         # with FSL so that all transformations would be in one step, but
@@ -114,28 +154,42 @@ else:
         # ITK/ANTS warps to FSL format. So will settle for two
         # interpolations to take the raw bold to motion-corrected,
         # unwarped common functional space
-        warp = xfm_base + "1Warp.nii.gz"
         log.run(
             "antsApplyTransforms -d 3 -e 3 -i {} -o {} -r {} -t {} -n BSpline".format(
                 bold_init, bold_reg, refvol, warp
-            )
+            ),
+            inputs=[bold_init, refvol, warp],
+            outputs=[bold_reg],
         )
 
-    if not args.keep:
+    if not keep:
         log.run("rm -f %s" % bold_init)
 
 # estimate bias field based on the average over time (so the shape of
 # each voxel timeseries does not change)
-log.run("fslmaths %s -Tmean %s" % (bold_reg, bold_reg_avg))
+log.run(
+    "fprep-math %s -Tmean %s" % (bold_reg, bold_reg_avg),
+    inputs=[bold_reg],
+    outputs=[bold_reg_avg],
+)
+# (the corrected average is removed unless keeping intermediate files,
+# so only the bias field is needed to skip this step)
 log.run(
     "N4BiasFieldCorrection -d 3 -i %s -o [%s,%s]"
-    % (bold_reg_avg, bold_reg_avg_cor, bias)
+    % (bold_reg_avg, bold_reg_avg_cor, bias),
+    inputs=[bold_reg_avg],
+    outputs=[bias],
 )
 
-# correct for the bias field and mask with anatomical mask
-log.run("fslmaths %s -div %s -mas %s %s" % (bold_reg, bias, mask, output))
-if not args.keep:
+# correct for the bias field, mask with anatomical mask, and average,
+# reading the run only once
+log.run(
+    "fprep-math %s -div %s -mas %s %s -Tmean %s"
+    % (bold_reg, bias, mask, output, bold_reg_cor_brain_avg),
+    inputs=[bold_reg, bias, mask],
+    outputs=[output, bold_reg_cor_brain_avg],
+)
+if not keep:
     log.run("rm -f %s %s" % (bold_reg, bold_reg_avg_cor))
-log.run("fslmaths %s -Tmean %s" % (output, bold_reg_cor_brain_avg))
 
 log.finish()
@@ -12,6 +12,8 @@ sp = SubjPath(args.subject, args.study_dir)
 log = sp.init_log("rename", "preproc", args)
 
 log.start()
-heuristic.rename_bold(sp, log)
-heuristic.rename_anat(sp, log)
+# read DICOM headers once for both steps
+hdrs, dirs = heuristic.dicom_headers(sp, log)
+heuristic.rename_bold(sp, log, hdrs)
+heuristic.rename_anat(sp, log, hdrs)
 log.finish()
@@ -72,7 +72,7 @@ for image_name in images:
         anat2func,
         out_file,
     )
-    log.run(cmd)
+    log.submit(cmd, inputs=[in_file, refvol, anat2func], outputs=[out_file])
 
 # can't use interpolation on label images
 for image_name in labels:
@@ -84,12 +84,14 @@ for image_name in labels:
         anat2func,
         out_file,
     )
-    log.run(cmd)
+    log.submit(cmd, inputs=[in_file, refvol, anat2func], outputs=[out_file])
 
 # run a check on the registration
 image_file = impath(reg_data, images[0])
 png_file = "%s2refvol.png" % images[0]
 cmd = "reg_slice_check.sh %s %s %s %s" % (image_file, refvol, reg_check, png_file)
-log.run(cmd)
+log.submit(
+    cmd, inputs=[image_file, refvol], outputs=[os.path.join(reg_check, png_file)]
+)
 
 log.finish()
@@ -0,0 +1,343 @@
+"""Run a processing script for many subjects or runs on the local node."""
+
+import os
+import re
+import json
+import shlex
+import signal
+import threading
+import time
+import argparse
+import subprocess as sub
+from concurrent import futures
+from datetime import datetime
+from fprep.subjutil import wait_usage, thread_vars, job_env
+
+
+def split_budget(n_cores, n_jobs, max_workers=None, n_threads=None):
+    """
+    Split a core budget into concurrent jobs and threads per job.
+
+    If neither max_workers nor n_threads is set, up to one job is run
+    per core and cores are divided evenly between the running jobs.
+    Returns the number of workers and threads per job.
+    """
+    n_cores = max(n_cores, 1)
+    if max_workers is None:
+        if n_threads is None:
+            max_workers = n_cores
+        else:
+            max_workers = n_cores // n_threads
+    max_workers = max(min(max_workers, n_jobs), 1)
+    if n_threads is None:
+        n_threads = n_cores // max_workers
+    return max_workers, max(n_threads, 1)
+
+
+def log_name(args):
+    """File name for the log of a job."""
+    name = re.sub(r"[^\w.-]+", "_", "_".join(args)).strip("_")
+    return (name or "job") + ".log"
+
+
+class BatchState:
+    """
+    Status and timing of jobs for a script, saved in a JSON file.
+
+    The file is updated whenever a job starts or finishes. Wall time of
+    the last successful run of each job is used to start the longest
+    jobs first in later batches.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.jobs = {}
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                self.jobs = json.load(f)["jobs"]
+
+    def save(self):
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=1)
+        os.replace(temp_file, self.state_file)
+
+    def update(self, key, **kwargs):
+        self.jobs.setdefault(key, {}).update(kwargs)
+        self.save()
+
+    def is_done(self, key):
+        return self.jobs.get(key, {}).get("status") == "ok"
+
+    def estimate(self, key):
+        """Expected wall time of a job, or None if it has not finished before."""
+        return self.jobs.get(key, {}).get("wall_s")
+
+    def order(self, keys):
+        """
+        Order jobs with the longest expected time first.
+
+        Jobs without a previous timing are assumed to take the median
+        time of jobs that have one. Ties keep the input order.
+        """
+        times = sorted(t for t in map(self.estimate, keys) if t is not None)
+        default = times[len(times) // 2] if times else 0
+        expected = [self.estimate(key) for key in keys]
+        expected = [default if t is None else t for t in expected]
+        index = sorted(range(len(keys)), key=lambda i: -expected[i])
+        return [keys[i] for i in index]
+
+
+def run_job(cmd, env, log_file, running):
+    """Run a command in its own session; return exit code and usage."""
+    start = time.time()
+    with open(log_file, "w") as f:
+        p = sub.Popen(
+            cmd,
+            stdout=f,
+            stderr=sub.STDOUT,
+            env=env,
+            start_new_session=True,
+        )
+        running[p.pid] = p
+        try:
+            returncode, usage = wait_usage(p)
+        finally:
+            del running[p.pid]
+    usage["wall_s"] = time.time() - start
+    return returncode, usage
+
+
+def terminate(running, timeout=10):
+    """Terminate running jobs and any processes they started."""
+    for p in list(running.values()):
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    while running and time.time() < deadline:
+        time.sleep(0.1)
+    for p in list(running.values()):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def run_batch(
+    script,
+    jobs,
+    state_file,
+    log_dir,
+    n_cores=None,
+    max_workers=None,
+    n_threads=None,
+    resume=False,
+    dry_run=False,
+):
+    """
+    Run a script for a list of jobs, using a budget of cores.
+
+    Each job is a list of arguments to add to the script command. Jobs
+    are started with the longest expected time first, and thread
+    environment variables are set so that running jobs share the cores.
+    If resume is True, jobs that finished successfully in a previous
+    batch are skipped. If the batch is terminated, running jobs are
+    stopped and are run again on resume. Returns a dict with the status
+    of each job.
+    """
+    if n_cores is None:
+        n_cores = os.cpu_count() or 1
+    state = BatchState(state_file)
+    commands = {shlex.join(script + args): script + args for args in jobs}
+    keys = list(commands)
+    if resume:
+        for key in keys:
+            if state.is_done(key):
+                print("Skipping completed job: %s" % key)
+        keys = [key for key in keys if not state.is_done(key)]
+    keys = state.order(keys)
+    if not keys:
+        return {}
+    max_workers, n_threads = split_budget(n_cores, len(keys), max_workers, n_threads)
+    print(
+        "Running %d jobs, %d at a time with %d threads each."
+        % (len(keys), max_workers, n_threads)
+    )
+    if dry_run:
+        for key in keys:
+            estimate = state.estimate(key)
+            if estimate is None:
+                print(key)
+            else:
+                print("%s (%.0f s)" % (key, estimate))
+        return {}
+
+    os.makedirs(log_dir, exist_ok=True)
+    env = job_env(n_threads)
+    running = {}
+    pending = {}
+    status = {}
+
+    # convert termination into an exception so that jobs are cleaned up
+    def handle_term(signum, frame):
+        raise KeyboardInterrupt
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_term)
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for key in keys:
+            log_file = os.path.join(log_dir, log_name(commands[key][len(script) :]))
+            future = executor.submit(run_job, commands[key], env, log_file, running)
+            pending[future] = key
+        for key in keys:
+            state.jobs.setdefault(key, {})["status"] = "queued"
+        state.save()
+
+        not_done = set(pending)
+        started = set()
+        while not_done:
+            done, not_done = futures.wait(
+                not_done, timeout=1, return_when=futures.FIRST_COMPLETED
+            )
+            for future in not_done:
+                key = pending[future]
+                if future.running() and key not in started:
+                    started.add(key)
+                    state.update(
+                        key,
+                        status="running",
+                        started=datetime.now().isoformat(timespec="seconds"),
+                    )
+            for future in done:
+                key = pending[future]
+                try:
+                    returncode, usage = future.result()
+                except OSError as err:
+                    status[key] = "failed: %s" % err
+                    state.update(key, status="failed")
+                    print("%s: %s" % (key, status[key]))
+                    continue
+                if returncode == 0:
+                    status[key] = "ok"
+                    state.update(
+                        key, status="ok", threads=n_threads, exit_code=0, **usage
+                    )
+                else:
+                    status[key] = "failed with exit code %d" % returncode
+                    state.update(key, status="failed", exit_code=returncode)
+                print("%s: %s (%.0f s)" % (key, status[key], usage["wall_s"]))
+    except KeyboardInterrupt:
+        print("Batch interrupted; stopping running jobs.")
+        for future in pending:
+            future.cancel()
+        terminate(running)
+        for key in keys:
+            if key not in status:
+                state.jobs[key]["status"] = "interrupted"
+        state.save()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    return status
+
+
+def read_jobs(job_file):
+    """Read job arguments from a file, with one job per line."""
+    jobs = []
+    with open(job_file, "r") as f:
+        for line in f:
+            args = shlex.split(line, comments=True)
+            if args:
+                jobs.append(args)
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a script for many subjects or runs on the local node.",
+        epilog="Each job is a quoted set of arguments to the script, such as "
+        "a subject or a subject and run. Thread variables (%s) are set for "
+        "each job so that running jobs share the available cores."
+        % ", ".join(thread_vars),
+    )
+    parser.add_argument("script", help="script to run, with any fixed options")
+    parser.add_argument("jobs", nargs="*", help="arguments for each job")
+    parser.add_argument(
+        "-f", "--job-file", help="file with the arguments for one job per line"
+    )
+    parser.add_argument(
+        "--study-dir",
+        default=os.environ.get("STUDYDIR"),
+        help="path to main study directory (default: STUDYDIR)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cores",
+        type=int,
+        default=os.cpu_count(),
+        help="total number of cores to use (default: all)",
+    )
+    parser.add_argument(
+        "-n", "--workers", type=int, help="maximum number of jobs to run at once"
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        help="threads per job (default: cores divided by workers)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip jobs that finished successfully in a previous batch",
+    )
+    parser.add_argument(
+        "--state",
+        help="job status and timing file " "(default: [study-dir]/batch/[script].json)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the order jobs would run in"
+    )
+    args = parser.parse_args()
+
+    if args.study_dir is None:
+        raise ValueError("STUDYDIR not defined.")
+    script = shlex.split(args.script)
+    name = os.path.splitext(os.path.basename(script[0]))[0]
+    batch_dir = os.path.join(args.study_dir, "batch")
+    os.makedirs(batch_dir, exist_ok=True)
+    state_file = args.state
+    if state_file is None:
+        state_file = os.path.join(batch_dir, name + ".json")
+    log_dir = os.path.join(batch_dir, "logs", name)
+
+    jobs = [shlex.split(job) for job in args.jobs]
+    if args.job_file:
+        jobs += read_jobs(args.job_file)
+    if not jobs:
+        parser.error("no jobs specified")
+
+    try:
+        status = run_batch(
+            script,
+            jobs,
+            state_file,
+            log_dir,
+            args.cores,
+            args.workers,
+            args.threads,
+            args.resume,
+            args.dry_run,
+        )
+    except KeyboardInterrupt:
+        return 130
+    failed = [key for key, val in status.items() if val != "ok"]
+    if failed:
+        print("%d of %d jobs failed." % (len(failed), len(status)))
+        return 1
+    return 0
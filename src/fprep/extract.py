@@ -0,0 +1,174 @@
+"""Extract ROI time series and tSNR from functional runs."""
+
+import os
+import argparse
+from concurrent import futures
+import numpy as np
+from fprep import image
+from fprep import roi
+from fprep.subjutil import imname
+
+
+def label_groups(labels, rois):
+    """
+    Group voxels by label for a set of ROIs.
+
+    Returns the flat indices of voxels in any ROI, the group of each of
+    those voxels, and an ROI by group membership matrix.
+    """
+    values, index = np.unique(labels, return_inverse=True)
+    maker = roi.ROIMaker(values, rois)
+    member = np.array([maker.evaluate(name) > 0 for name in rois])
+
+    # only keep labels that are in at least one ROI
+    used = member.any(axis=0)
+    group = np.cumsum(used) - 1
+    index = index.ravel()
+    voxels = np.flatnonzero(used[index])
+    return voxels, group[index[voxels]], member[:, used]
+
+
+def chunk_size(shape, n_voxels, max_memory):
+    """Number of volumes to read at once within a memory limit in MB."""
+    # float32 volumes and float64 copies of the ROI voxels
+    per_volume = int(np.prod(shape[:3])) * 4 + n_voxels * 24
+    return int(max(1, min(shape[3], max_memory * 1024 ** 2 // per_volume)))
+
+
+def roi_stats(infile, labels, rois, max_memory=512):
+    """
+    Calculate mean time series and tSNR for each ROI in a run.
+
+    The run is read once, a block of volumes at a time. Voxel sums for
+    each label are calculated for all volumes in a block together, then
+    combined into ROIs. tSNR is the temporal mean over the standard
+    deviation of each voxel, averaged over the ROI voxels with non-zero
+    variance. Returns a dict with ROI names, timeseries (ROI x time),
+    tsnr, and n_voxels.
+    """
+    img = image.load(infile)
+    if img.ndim != 4 or img.shape[:3] != labels.shape:
+        raise ValueError(
+            "Run %s with shape %s does not match labels with shape %s."
+            % (infile, img.shape, labels.shape)
+        )
+    voxels, group, member = label_groups(labels, rois)
+    n_groups = member.shape[1]
+    n_vols = img.shape[3]
+
+    source = image.get_source(img)
+    group_sums = np.zeros((n_groups, n_vols))
+    ref = None
+    vox_sum = np.zeros(len(voxels))
+    vox_sumsq = np.zeros(len(voxels))
+    chunk = chunk_size(img.shape, len(voxels), max_memory)
+    for start in range(0, n_vols, chunk):
+        finish = min(start + chunk, n_vols)
+        n = finish - start
+        data = image.read_volumes(source, start, finish).reshape(-1, n)
+        data = data[voxels].astype(np.float64)
+
+        # sums for each group and volume in one count
+        bins = group[:, None] + n_groups * np.arange(n)
+        sums = np.bincount(bins.ravel(), data.ravel(), minlength=n_groups * n)
+        group_sums[:, start:finish] = sums.reshape(n, n_groups).T
+
+        # voxel sums relative to the first volume, to limit round-off
+        if ref is None:
+            ref = data[:, 0].copy()
+        diff = data - ref[:, None]
+        vox_sum += diff.sum(axis=1)
+        vox_sumsq += (diff ** 2).sum(axis=1)
+
+    # combine groups into ROIs
+    group_n = np.bincount(group, minlength=n_groups)
+    n_voxels = member @ group_n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        timeseries = (member @ group_sums) / n_voxels[:, None]
+
+        diff_mean = vox_sum / n_vols
+        vox_std = np.sqrt(np.maximum(vox_sumsq / n_vols - diff_mean ** 2, 0))
+        vox_tsnr = (ref + diff_mean) / vox_std
+        valid = np.isfinite(vox_tsnr) & (vox_std > 0)
+        tsnr_sum = np.bincount(group[valid], vox_tsnr[valid], minlength=n_groups)
+        tsnr_n = np.bincount(group[valid], minlength=n_groups)
+        tsnr = (member @ tsnr_sum) / (member @ tsnr_n)
+
+    return {
+        "rois": np.array(list(rois)),
+        "timeseries": timeseries.astype(np.float32),
+        "tsnr": tsnr.astype(np.float32),
+        "n_voxels": n_voxels,
+    }
+
+
+def output_file(infile, out_dir=None):
+    """Path to the ROI statistics file for a run."""
+    if out_dir is None:
+        out_dir = os.path.dirname(os.path.abspath(infile))
+    return os.path.join(out_dir, imname(infile) + "_roi.npz")
+
+
+def extract_run(infile, parcfile, rois, outfile, max_memory=512):
+    """Calculate ROI statistics for a run and save them to a file."""
+    labels = np.asarray(image.get_data(image.load(parcfile)))
+    stats = roi_stats(infile, labels, rois, max_memory)
+    stats["run"] = os.path.abspath(infile)
+    stats["labels"] = os.path.abspath(parcfile)
+
+    # write to a temporary file so that partial outputs are not left
+    temp_file = outfile + ".tmp.npz"
+    np.savez(temp_file, **stats)
+    os.replace(temp_file, outfile)
+    return outfile
+
+
+def extract_runs(runs, parcfile, rois, out_dir=None, n_workers=None, max_memory=512):
+    """Extract ROI statistics for multiple runs in parallel."""
+    outfiles = [output_file(infile, out_dir) for infile in runs]
+    with futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        jobs = [
+            executor.submit(extract_run, infile, parcfile, rois, outfile, max_memory)
+            for infile, outfile in zip(runs, outfiles)
+        ]
+        for job in jobs:
+            job.result()
+    return outfiles
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract ROI mean time series and tSNR from functional runs.",
+        epilog="Statistics for each run are saved in [run]_roi.npz, with "
+        "arrays rois, timeseries (ROI x time), tsnr, and n_voxels.",
+    )
+    parser.add_argument("parcfile", help="FreeSurfer labels in functional space")
+    parser.add_argument("runs", nargs="+", help="functional runs")
+    parser.add_argument(
+        "-o", "--out-dir", help="output directory (default: directory of each run)"
+    )
+    parser.add_argument(
+        "--set",
+        choices=list(roi.roi_sets),
+        action="append",
+        help="ROI set to extract (default: all sets)",
+    )
+    parser.add_argument(
+        "-n", "--workers", type=int, help="number of runs to process at once"
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=512,
+        help="MB of volumes to read at once for each run (default: 512)",
+    )
+    args = parser.parse_args()
+
+    rois = {}
+    for name in args.set if args.set else roi.roi_sets:
+        rois.update(roi.roi_sets[name])
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    extract_runs(
+        args.runs, args.parcfile, rois, args.out_dir, args.workers, args.max_memory
+    )
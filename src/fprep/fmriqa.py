@@ -0,0 +1,447 @@
+"""
+fMRI quality control
+- adapted from fsld_raw.R and fBIRN QA tools
+
+USAGE: fmriqa.py bold_mcf.nii.gz [TR] [--tr-image bold.nii.gz] [--max-memory MB]
+       [--save-png] [--no-cache] [--profile]
+"""
+
+import io
+import sys
+import contextlib
+import os
+import re
+import argparse
+import numpy as np
+import nibabel as nib
+from fprep import qa
+from fprep import image
+from fprep import headers
+from fprep import profiling
+
+# thresholds for scrubbing and spike detection
+FDthresh = 0.5
+DVARSthresh = 0.5
+AJKZ_thresh = 25
+
+# number of timepoints forward and back to scrub
+nback = 1
+nforward = 2
+
+
+def error_and_exit(msg):
+    print(msg)
+    sys.stdout.write(__doc__)
+    sys.exit(2)
+
+
+def main():
+    verbose = True
+
+    parser = argparse.ArgumentParser(
+        description="Calculate quality assurance statistics for fMRI data."
+    )
+    parser.add_argument("infile", help="motion-corrected image (XXX_mcf.nii.gz)")
+    parser.add_argument(
+        "TR",
+        type=float,
+        nargs="?",
+        help="repetition time in s (default: read from image header)",
+    )
+    parser.add_argument(
+        "--tr-image",
+        help="image to read the repetition time from (default: infile)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        help="process volumes in chunks using at most this many MB",
+    )
+    parser.add_argument(
+        "--save-png",
+        action="store_true",
+        help="save report figures as PNG files in the QA directory",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recalculate image statistics even if inputs are unchanged",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="save time and memory use of each stage to QA/profile.json "
+        "(default: set by FPREP_PROFILE)",
+    )
+    args = parser.parse_args()
+
+    fmriqa(
+        args.infile,
+        args.TR,
+        verbose=verbose,
+        tr_image=args.tr_image,
+        plot_data=True,
+        max_memory=args.max_memory,
+        save_png=args.save_png,
+        use_cache=not args.no_cache,
+        profile=args.profile,
+    )
+
+
+def image_stats(img, maskvox, nonmaskvox, max_memory=None, verbose=False):
+    """Calculate voxel, volume, and spike statistics for a run."""
+    nslices = img.shape[2]
+
+    # perform Greve et al./fBIRN spike detection
+    # 1. Remove mean and temporal trend from each voxel.
+    # 2. Compute temporal Z-score for each voxel.
+    # 3. Average the absolute Z-score (AAZ) within a each slice and time point separately.
+    # This gives a matrix with number of rows equal to the number of slices (nSlices)
+    # and number of columns equal to the number of time points (nFrames).
+    # 4. Compute new Z-scores using a jackknife across the slices (JKZ). For a given time point,
+    # remove one of the slices, compute the average and standard deviation of the AAZ across
+    # the remaining slices. Use these two numbers to compute a Z for the slice left out
+    # (this is the JKZ). The final Spike Measure is the absolute value of the JKZ (AJKZ).
+    # Repeat for all slices. This gives a new nSlices-by-nFrames matrix (see Figure 8).
+    # This procedure tends to remove components that are common across slices and so rejects motion.
+    if max_memory is None:
+        # data are kept in their stored type; statistics are calculated
+        # in float64
+        imgdata = image.get_data(img)
+        voxmean = np.mean(imgdata, 3, dtype=np.float64)
+        voxstd = np.std(imgdata, 3, dtype=np.float64)
+
+        # compute timepoint statistics
+        brain = imgdata[maskvox].astype(np.float64)
+        nonbrain = imgdata[nonmaskvox]
+        del imgdata
+        maskmedian, maskmad, maskmean, maskcv, imgsnr = qa.mask_stats(brain, nonbrain)
+        del nonbrain
+
+        if verbose:
+            print("computing spike stats")
+
+        # mask voxels are sorted by slice, so each slice is a contiguous
+        # block of rows in the (voxels x time) matrix
+        detrended_zscore = qa.detrend_zscore(brain)
+        AAZ = qa.slice_aaz(
+            detrended_zscore, maskvox[2], nslices, img.shape[0] * img.shape[1]
+        )
+        del brain, detrended_zscore
+        stats = {
+            "voxmean": voxmean,
+            "voxstd": voxstd,
+            "maskmedian": maskmedian,
+            "maskmad": maskmad,
+            "maskmean": maskmean,
+            "maskcv": maskcv,
+            "imgsnr": imgsnr,
+            "AAZ": AAZ,
+        }
+    else:
+        # read a limited number of volumes at a time
+        chunk_size = qa.chunk_volumes(img.shape, len(maskvox[0]), max_memory)
+        if verbose:
+            print("computing stats in chunks of %d volumes" % chunk_size)
+        stats = qa.chunked_stats(img, maskvox, nonmaskvox, chunk_size)
+    return stats
+
+
+def fmriqa(
+    infile,
+    TR=None,
+    outdir=None,
+    maskfile=None,
+    motfile=None,
+    verbose=False,
+    plot_data=True,
+    max_memory=None,
+    save_png=False,
+    FDthresh=FDthresh,
+    DVARSthresh=DVARSthresh,
+    AJKZ_thresh=AJKZ_thresh,
+    nback=nback,
+    nforward=nforward,
+    use_cache=True,
+    profile=None,
+    tr_image=None,
+):
+    save_sfnr = True
+
+    if os.path.dirname(infile) == "":
+        basedir = os.getcwd()
+        infile = os.path.join(basedir, infile)
+    elif os.path.dirname(infile) == ".":
+        basedir = os.getcwd()
+        infile = os.path.join(basedir, infile.replace("./", ""))
+    else:
+        basedir = os.path.dirname(infile)
+
+    if outdir is None:
+        outdir = basedir
+
+    qadir = os.path.join(outdir, "QA")
+
+    if not re.search(r"mcf\.nii(\.gz)?$", infile):
+        error_and_exit("infile must be of form XXX_mcf.nii.gz or XXX_mcf.nii")
+
+    if not os.path.exists(infile):
+        error_and_exit("%s does not exist!" % infile)
+
+    if maskfile is None:
+        maskfile = infile.replace("mcf.nii", "mcf_brain_mask.nii")
+
+    if not os.path.exists(maskfile):
+        error_and_exit("%s does not exist!" % maskfile)
+
+    if motfile is None:
+        motfile = re.sub(r"mcf\.nii(\.gz)?$", "mcf.par", infile)
+    if not os.path.exists(motfile):
+        error_and_exit("%s does not exist!" % motfile)
+
+    if TR is None:
+        # read from the header instead of the data
+        if tr_image is None:
+            tr_image = infile
+        TR = headers.header_info(tr_image)["tr"]
+        if not TR:
+            error_and_exit("Could not read TR from %s." % tr_image)
+
+    if not os.path.exists(qadir):
+        os.mkdir(qadir)
+    else:
+        print("QA dir already exists - overwriting!")
+
+    if verbose:
+        print("infile:", infile)
+        print("maskfile:", maskfile)
+        print("motfile:", motfile)
+        print("outdir:", outdir)
+        print("computing image stats")
+
+    if profile is None:
+        profile = profiling.env_enabled()
+    if profile:
+        # record time and memory use of each stage
+        profiler = profiling.profile(os.path.join(qadir, "profile.json"))
+    else:
+        profiler = contextlib.nullcontext()
+
+    with profiler:
+        with profiling.stage("load"):
+            # uncompressed images are memory-mapped rather than read into memory
+            img = image.load(infile)
+
+            maskimg = image.load(maskfile)
+            maskdata = image.get_data(maskimg)
+            maskvox = np.where(maskdata > 0)
+            slice_order = np.argsort(maskvox[2], kind="stable")
+            maskvox = tuple(ind[slice_order] for ind in maskvox)
+            nonmaskvox = np.where(maskdata == 0)
+            if verbose:
+                print("nmaskvox:", len(maskvox[0]))
+
+            # load motion parameters and compute FD and identify bad vols for
+            # potential scrubbing (ala Power et al.)
+            motpars = np.loadtxt(motfile)
+
+        with profiling.stage("image_stats"):
+            # statistics from the image data do not depend on the thresholds,
+            # so reuse them if the inputs have not changed
+            cachefile = os.path.join(qadir, "cache.npz")
+            stats = None
+            if use_cache:
+                key = qa.fingerprint([infile, maskfile, motfile])
+                stats = qa.load_cache(cachefile, key)
+                if stats is not None and verbose:
+                    print("using cached image stats")
+
+            if stats is None:
+                stats = image_stats(img, maskvox, nonmaskvox, max_memory, verbose)
+                stats["fd"] = qa.compute_fd(motpars)
+                stats["AJKZ"] = np.abs(qa.jackknife_z(stats["AAZ"]))
+                if use_cache:
+                    qa.save_cache(cachefile, key, stats)
+
+            fd = stats["fd"]
+            np.savetxt(os.path.join(qadir, "fd.txt"), fd)
+            voxmean = stats["voxmean"]
+            voxstd = stats["voxstd"]
+            maskmad = stats["maskmad"]
+            maskmean = stats["maskmean"]
+            imgsnr = stats["imgsnr"]
+            AJKZ = stats["AJKZ"]
+
+        with profiling.stage("spikes"):
+            voxcv = voxstd / np.abs(voxmean)
+            voxcv[np.isnan(voxcv)] = 0
+            voxcv[voxcv > 1] = 1
+
+            if verbose:
+                print("computing outliers")
+            spikes = []
+            if np.max(AJKZ) > AJKZ_thresh:
+                print("Possible spike: Max AJKZ = %f" % np.max(AJKZ))
+                spikes = np.where(np.max(AJKZ, 0) > AJKZ_thresh)[0]
+            if len(spikes) > 0:
+                np.savetxt(os.path.join(qadir, "spikes.txt"), spikes)
+
+            voxsfnr = voxmean / voxstd
+            meansfnr = np.mean(voxsfnr[maskvox])
+
+        with profiling.stage("scrub"):
+            # create plots
+            if verbose:
+                print("checking for bad volumes")
+            mean_running_diff = (maskmean[1:] - maskmean[:-1]) / (
+                (maskmean[1:] + maskmean[:-1]) / 2.0
+            )
+            DVARS = np.zeros(fd.shape)
+            DVARS[1:] = np.sqrt(mean_running_diff ** 2) * 100.0
+            np.savetxt(os.path.join(qadir, "dvars.txt"), DVARS)
+
+            badvol_index_orig = np.where((fd > FDthresh) * (DVARS > DVARSthresh))[0]
+            badvols = np.zeros(len(DVARS))
+            badvols[badvol_index_orig] = 1
+            badvols_expanded = badvols.copy()
+            for i in badvol_index_orig:
+                if i > (nback - 1):
+                    start = i - nback
+                else:
+                    start = 0
+                if i < (len(badvols) - nforward):
+                    end = i + nforward + 1
+                else:
+                    end = len(badvols)
+                badvols_expanded[start:end] = 1
+            badvols_expanded_index = np.where(badvols_expanded > 0)[0]
+            if len(badvols_expanded_index) > 0:
+                if verbose:
+                    print("writing scrub volumes")
+                np.savetxt(
+                    os.path.join(qadir, "scrubvols.txt"),
+                    badvols_expanded_index,
+                    fmt="%d",
+                )
+
+                # make scrubing design matrix - one colum per scrubbed timepoint
+                scrubdes = np.zeros((len(DVARS), len(badvols_expanded_index)))
+                for i in range(len(badvols_expanded_index)):
+                    scrubdes[badvols_expanded_index[i], i] = 1
+                np.savetxt(os.path.join(qadir, "scrubdes.txt"), scrubdes, fmt="%d")
+            else:
+                scrubdes = None
+
+        with profiling.stage("confounds"):
+            # save out complete confound file
+            if verbose:
+                print("writing confound file")
+            confound_mtx = np.zeros((len(DVARS), 14))
+            confound_mtx[:, 0:6] = motpars
+            confound_mtx[1:, 6:12] = motpars[:-1, :] - motpars[1:, :]  # derivs
+            confound_mtx[:, 12] = fd
+            confound_mtx[:, 13] = DVARS
+            if scrubdes is not None:
+                confound_mtx = np.hstack((confound_mtx, scrubdes))
+
+            np.savetxt(os.path.join(qadir, "confound.txt"), confound_mtx)
+
+            # give 12 and 24 columns options
+            motonly = confound_mtx[:, :12]
+            motonly_squared = np.hstack((motonly, np.power(motonly, 2)))
+            np.savetxt(os.path.join(qadir, "confound12.txt"), motonly)
+            np.savetxt(os.path.join(qadir, "confound24.txt"), motonly_squared)
+
+            datavars = {
+                "imgsnr": imgsnr,
+                "meansfnr": meansfnr,
+                "spikes": spikes,
+                "badvols": badvols_expanded_index,
+            }
+
+        if plot_data:
+            with profiling.stage("plots"):
+                # figures are rendered to in-memory buffers and drawn directly in
+                # the report; PNG files are only written if requested
+                images = {name: io.BytesIO() for name in qa.report_images}
+
+                if verbose:
+                    print("plotting timeseries data")
+                trend = qa.plot_timeseries(
+                    maskmean,
+                    "Mean signal (unfiltered)",
+                    images["maskmean.png"],
+                    plottrend=True,
+                    ylabel="Mean MR signal",
+                )
+                datavars["trend"] = trend
+                qa.plot_timeseries(
+                    maskmad,
+                    "Median absolute deviation (robust SD)",
+                    images["mad.png"],
+                    ylabel="MAD",
+                )
+
+                qa.plot_timeseries(
+                    DVARS,
+                    "DVARS (root mean squared signal derivative over brain mask)",
+                    images["DVARS.png"],
+                    plotline=0.5,
+                    ylabel="DVARS",
+                )
+
+                qa.plot_timeseries(
+                    fd,
+                    "Framewise displacement",
+                    images["fd.png"],
+                    markers=badvols_expanded_index,
+                    markername="Timepoints to scrub (%d total)" % len(badvols),
+                    plotline=0.5,
+                    ylims=[0, 1],
+                    ylabel="FD",
+                )
+
+                qa.plot_psd(maskmean, TR, images["meanpsd.png"])
+                qa.plot_spikes(AJKZ, AJKZ_thresh, images["spike.png"])
+
+                if verbose:
+                    print("plotting volume data")
+                qa.mk_slice_mosaics(
+                    [voxmean, voxcv, voxsfnr],
+                    [images["voxmean.png"], images["voxcv.png"], images["voxsfnr.png"]],
+                    ["Image mean (with mask)", "Image CV", "Image SFNR"],
+                    contourdata=maskdata,
+                    contour=[True, False, False],
+                )
+
+            with profiling.stage("report"):
+                if verbose:
+                    print("creating report")
+                qa.mk_report(infile, qadir, datavars, images)
+                if save_png:
+                    qa.save_images(images, qadir)
+
+        with profiling.stage("write"):
+            if verbose:
+                print("writing QA data")
+            datafile = os.path.join(qadir, "qadata.csv")
+            f = open(datafile, "w")
+            f.write("SNR,%f\n" % np.mean(datavars["imgsnr"]))
+            f.write("SFNR,%f\n" % datavars["meansfnr"])
+            f.write("nspikes,%d\n" % len(datavars["spikes"]))
+            f.write("nscrub,%d\n" % len(datavars["badvols"]))
+            f.write("meanFD,%f\n" % np.mean(fd))
+            f.write("maxAJKZ,%f\n" % np.max(AJKZ))
+            f.close()
+
+            if save_sfnr:
+                print("writing sfnr image")
+                sfnrimg = nib.Nifti1Image(voxsfnr, img.affine)
+                sfnrimg.to_filename(os.path.join(qadir, "voxsfnr.nii.gz"))
+    return qadir
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Index of NIfTI header information for a study."""
+
+import os
+import json
+import sqlite3
+import argparse
+from concurrent import futures
+
+# header fields stored for each image
+fields = ["shape", "zooms", "tr", "datatype", "n_volumes"]
+
+schema = (
+    "CREATE TABLE IF NOT EXISTS headers "
+    "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, info TEXT)"
+)
+
+# conversion of time units to seconds
+time_units = {"sec": 1.0, "msec": 1e-3, "usec": 1e-6}
+
+
+def read_header(filepath):
+    """
+    Read information from a NIfTI header.
+
+    Only the header bytes are read; for compressed images, only the
+    start of the file is decompressed.
+    """
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+
+    with ImageOpener(filepath) as f:
+        block = f.read(540)
+
+    if len(block) >= 540 and 540 in (
+        int.from_bytes(block[:4], "little"),
+        int.from_bytes(block[:4], "big"),
+    ):
+        header = nib.Nifti2Header(block[:540])
+    else:
+        header = nib.Nifti1Header(block[:348])
+
+    shape = [int(n) for n in header.get_data_shape()]
+    zooms = [float(z) for z in header.get_zooms()]
+    tr = None
+    if len(zooms) > 3:
+        units = header.get_xyzt_units()[1]
+        tr = zooms[3] * time_units.get(units, 1.0)
+    return {
+        "shape": shape,
+        "zooms": zooms,
+        "tr": tr,
+        "datatype": str(header.get_data_dtype()),
+        "n_volumes": shape[3] if len(shape) > 3 else 1,
+    }
+
+
+def default_index_file():
+    """Default location of the header index database."""
+    if "FPREP_HEADER_INDEX" in os.environ:
+        return os.environ["FPREP_HEADER_INDEX"]
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "fprep", "headers.sqlite")
+
+
+class HeaderIndex:
+    """
+    Header information for images, cached in a database.
+
+    Entries are keyed by absolute path and are used only if the file
+    size and modification time are unchanged. If the database cannot be
+    created, read, or written (for example, if it is locked by another
+    job), headers are read without caching.
+    """
+
+    def __init__(self, index_file=None, n_workers=8):
+        if index_file is None:
+            index_file = default_index_file()
+        self.n_workers = n_workers
+        try:
+            if index_file != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+            self.db = sqlite3.connect(index_file, timeout=30)
+            self.db.execute(schema)
+        except (OSError, sqlite3.Error):
+            self.db = sqlite3.connect(":memory:")
+            self.db.execute(schema)
+
+    def close(self):
+        self.db.close()
+
+    def get(self, files):
+        """Get header information for a list of files."""
+        paths = [os.path.abspath(f) for f in files]
+        stats = {p: os.stat(p) for p in set(paths)}
+
+        # look up cached entries that match the current file state; if
+        # the database is locked or cannot be read, read all headers
+        cached = {}
+        try:
+            for path, st in stats.items():
+                row = self.db.execute(
+                    "SELECT size, mtime_ns, info FROM headers WHERE path = ?", (path,)
+                ).fetchone()
+                if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+                    cached[path] = json.loads(row[2])
+        except sqlite3.Error:
+            cached = {}
+
+        # read remaining headers in parallel
+        missing = [p for p in stats if p not in cached]
+        if missing:
+            n_workers = min(self.n_workers, len(missing))
+            with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                infos = list(executor.map(read_header, missing))
+            try:
+                with self.db:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)",
+                        [
+                            (p, stats[p].st_size, stats[p].st_mtime_ns, json.dumps(info))
+                            for p, info in zip(missing, infos)
+                        ],
+                    )
+            except sqlite3.Error:
+                # headers are still returned if they cannot be cached
+                pass
+            cached.update(zip(missing, infos))
+        return [cached[p] for p in paths]
+
+
+def get_info(files, index_file=None):
+    """Get header information for a list of files using the index."""
+    index = HeaderIndex(index_file)
+    try:
+        return index.get(files)
+    finally:
+        index.close()
+
+
+def header_info(filepath, index_file=None):
+    """Get header information for one file using the index."""
+    return get_info([filepath], index_file)[0]
+
+
+def format_value(value):
+    if isinstance(value, list):
+        return " ".join(format_value(v) for v in value)
+    if isinstance(value, float):
+        return "%g" % value
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print header information for NIfTI images."
+    )
+    parser.add_argument("files", nargs="+", help="image files")
+    parser.add_argument(
+        "-f",
+        "--field",
+        choices=fields,
+        action="append",
+        help="field to print (default: all)",
+    )
+    parser.add_argument(
+        "--index",
+        help="header index database (default: FPREP_HEADER_INDEX or "
+        "~/.cache/fprep/headers.sqlite)",
+    )
+    args = parser.parse_args()
+
+    show = args.field if args.field else fields
+    infos = get_info(args.files, args.index)
+    for filepath, info in zip(args.files, infos):
+        values = [format_value(info[field]) for field in show]
+        if len(args.files) > 1:
+            values.insert(0, filepath)
+        print("\t".join(values))
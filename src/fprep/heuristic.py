@@ -1,8 +1,9 @@
 """Set heuristics for parsing DICOM files."""
 
 import os
-import pydicom
+import sys
 import pickle
+from concurrent import futures
 
 
 def dicom_filetype(hdr):
@@ -56,35 +57,62 @@ def dicom_files(dcmdir):
     return files
 
 
-def dicom_headers(sp):
-    """Read a DICOM header for all series."""
+# header fields used by dicom_filetype, find_header, and the rename functions
+header_tags = ["SeriesNumber", "ImageType", "ProtocolName", "SeriesDescription"]
 
+
+def read_series_header(dcmdir, tags=None):
+    """Read fields from the header of the first DICOM file in a series."""
+    import pydicom
+
+    dcmfiles = dicom_files(dcmdir)
+    if not dcmfiles:
+        raise IOError("No DICOM files found.")
+    hdr = pydicom.dcmread(
+        os.path.join(dcmdir, dcmfiles[0]),
+        stop_before_pixels=True,
+        specific_tags=header_tags if tags is None else tags,
+    )
+    if "SeriesNumber" not in hdr:
+        raise ValueError("Header has no series number.")
+    return hdr
+
+
+def dicom_headers(sp, log=None, n_workers=8):
+    """
+    Read a DICOM header for all series.
+
+    Only the fields in header_tags are read, and series directories are
+    read in parallel. Series that cannot be read are reported in the
+    log, or to stderr if there is no log.
+    """
     dcmbase = sp.path("raw", sp.subject)
-    dcmdirs = os.listdir(dcmbase)
+    dcmdirs = [os.path.join(dcmbase, d) for d in sorted(os.listdir(dcmbase))]
+    dcmdirs = [d for d in dcmdirs if os.path.isdir(d)]
     hdrs = {}
     dirs = {}
-    for d in dcmdirs:
-        dcmdir = os.path.join(dcmbase, d)
-        if not os.path.isdir(dcmdir):
-            continue
-
-        # get all dicom files for this scan
-        dcmfiles = dicom_files(dcmdir)
-
-        # attempt to read the first file's header
-        try:
-            hdr = pydicom.read_file(os.path.join(dcmdir, dcmfiles[0]))
-        except:
-            continue
-        series = str(hdr.SeriesNumber)
-        hdrs[series] = hdr
-        dirs[series] = dcmdir
+    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        jobs = [executor.submit(read_series_header, d) for d in dcmdirs]
+        for dcmdir, job in zip(dcmdirs, jobs):
+            try:
+                hdr = job.result()
+            except Exception as err:
+                message = "Could not read DICOM series %s: %s" % (dcmdir, err)
+                if log is not None:
+                    log.write(message)
+                else:
+                    print(message, file=sys.stderr)
+                continue
+            series = str(hdr.SeriesNumber)
+            hdrs[series] = hdr
+            dirs[series] = dcmdir
     return hdrs, dirs
 
 
-def dicom2nifti(sp, log):
+def dicom2nifti(sp, log, hdrs=None, dirs=None):
     """Convert all DICOM files to NIfTI format."""
-    hdrs, dirs = dicom_headers(sp)
+    if hdrs is None or dirs is None:
+        hdrs, dirs = dicom_headers(sp, log)
     for series in list(hdrs.keys()):
         # set the output directory (based on filetype)
         filetype = dicom_filetype(hdrs[series])
@@ -121,9 +149,10 @@ def find_header(hdrs, nifti_file):
     return hdrs[series]
 
 
-def rename_bold(sp, log):
+def rename_bold(sp, log, hdrs=None):
     """Rename BOLD files and move to separate directories."""
-    hdrs, dirs = dicom_headers(sp)
+    if hdrs is None:
+        hdrs, dirs = dicom_headers(sp, log)
     bold_files = sp.glob("bold", "*.nii.gz")
     for f in bold_files:
         # determine run information
@@ -138,9 +167,10 @@ def rename_bold(sp, log):
         log.run("mv %s %s" % (f, output))
 
 
-def rename_anat(sp, log):
+def rename_anat(sp, log, hdrs=None):
     """Give anatomical scans standard names and backup intermediate files."""
-    hdrs, dirs = dicom_headers(sp)
+    if hdrs is None:
+        hdrs, dirs = dicom_headers(sp, log)
     anat_files = sp.glob("anatomy", "*.nii.gz")
     anat_files.sort()
     highres_ind = 1
@@ -0,0 +1,80 @@
+"""Access to NIfTI image data with minimal copying."""
+
+import numpy as np
+import nibabel as nib
+
+compressed_ext = (".gz", ".bz2", ".zst")
+
+
+def load(filepath, mmap="r"):
+    """
+    Load an image without reading its data.
+
+    Data in uncompressed files are memory-mapped read-only, so reading
+    them costs little more than the page cache. Compressed files are
+    kept open, so that reading volumes in order continues from the last
+    read instead of decompressing from the start of the file each time.
+    """
+    keep_file_open = str(filepath).endswith(compressed_ext)
+    return nib.load(filepath, mmap=mmap, keep_file_open=keep_file_open)
+
+
+def has_scaling(img):
+    """Check whether image data must be scaled when read."""
+    dataobj = img.dataobj
+    if not nib.is_proxy(dataobj):
+        return False
+    slope = getattr(dataobj, "slope", 1.0)
+    inter = getattr(dataobj, "inter", 0.0)
+    return not (slope == 1 and inter == 0)
+
+
+def is_mapped(img):
+    """Check whether image data can be read from a memory map."""
+    filename = img.get_filename()
+    if filename is None or not nib.is_proxy(img.dataobj) or has_scaling(img):
+        return False
+    return not filename.endswith(compressed_ext)
+
+
+def get_data(img, dtype=None):
+    """
+    Get image data, converting only if needed.
+
+    Unscaled data are returned in their stored type (as a memory map for
+    uncompressed files) unless a different dtype is requested. Scaled
+    data are converted to float64, or to dtype if it is a float type.
+    """
+    if has_scaling(img):
+        if dtype is None or not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        return img.get_fdata(dtype=dtype)
+
+    data = np.asanyarray(img.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+
+def get_source(img):
+    """
+    Get an array-like source for reading ranges of volumes.
+
+    Memory-mapped images give the map itself, so that slices are views;
+    other images give the array proxy, which reads only the requested
+    volumes.
+    """
+    if is_mapped(img):
+        return np.asanyarray(img.dataobj)
+    return img.dataobj
+
+
+def read_volumes(source, start, finish, dtype=np.float32):
+    """
+    Read a range of volumes from a 4D image source.
+
+    Volumes are contiguous on disk, so for a memory map with a matching
+    dtype this returns a view without copying.
+    """
+    return np.asarray(source[..., start:finish], dtype=dtype)
+
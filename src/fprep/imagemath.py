@@ -0,0 +1,658 @@
+"""
+Image math with fslmaths-style operations, evaluated in one pass.
+
+Expressions are built lazily from images and operations, and any number
+of outputs are then evaluated together. Each input image is read once;
+4D images are read and written a block of volumes at a time, so that
+(for example) a corrected run and its temporal mean are calculated from
+a single read of the run.
+"""
+
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+from fprep import image
+
+# output data types, as named by fslmaths -odt
+data_types = {
+    "char": np.uint8,
+    "short": np.int16,
+    "int": np.int32,
+    "float": np.float32,
+    "double": np.float64,
+}
+
+
+def _thr(x, value):
+    return np.where(x < value, 0, x)
+
+
+def _uthr(x, value):
+    return np.where(x > value, 0, x)
+
+
+def _bin(x):
+    return (x > 0).astype(np.float32)
+
+
+def _mas(x, mask):
+    return np.where(mask > 0, x, 0)
+
+
+def _div(x, y):
+    # division by zero gives zero, as in fslmaths
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(y != 0, x / y, 0)
+
+
+def _fillh26(vol):
+    from scipy import ndimage
+
+    # holes are background regions not 26-connected to the edge
+    filled = ndimage.binary_fill_holes(vol > 0, structure=np.ones((3, 3, 3)))
+    return filled.astype(np.float32)
+
+
+def _dild(vol, kernel):
+    from scipy import ndimage
+
+    # zero voxels take the most common value of non-zero neighbors
+    out = vol.copy()
+    zero = vol == 0
+    best = np.zeros(vol.shape, dtype=np.float32)
+    for value in np.unique(vol[~zero]):
+        count = ndimage.convolve(
+            (vol == value).astype(np.float32), kernel, mode="constant"
+        )
+        update = zero & (count > best)
+        out[update] = value
+        best[update] = count[update]
+    return out
+
+
+elementwise = {
+    "thr": _thr,
+    "uthr": _uthr,
+    "bin": _bin,
+    "abs": np.abs,
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "div": _div,
+    "mas": _mas,
+}
+spatial = {"fillh26": _fillh26, "dilD": _dild}
+reductions = ["Tmean", "Tmax", "Tmin"]
+
+
+def make_kernel(kind, size=None, zooms=(1.0, 1.0, 1.0)):
+    """
+    Make a kernel for spatial filtering, as in fslmaths -kernel.
+
+    Sphere and box sizes are in mm; boxv sizes are in voxels. The
+    default 3D kernel is a 3x3x3 box.
+    """
+    if kind == "3D":
+        return np.ones((3, 3, 3), dtype=np.float32)
+    if kind == "boxv":
+        n = int(size)
+        return np.ones((n, n, n), dtype=np.float32)
+    zooms = np.asarray(zooms[:3], dtype=float)
+    if kind == "box":
+        n = 2 * np.floor(size / 2.0 / zooms).astype(int) + 1
+        return np.ones(n, dtype=np.float32)
+    if kind == "sphere":
+        extent = np.floor(size / zooms).astype(int)
+        grid = np.ogrid[tuple(slice(-e, e + 1) for e in extent)]
+        dist = sum((g * z) ** 2 for g, z in zip(grid, zooms))
+        return (dist <= size ** 2).astype(np.float32)
+    raise ValueError("Unknown kernel type: %s" % kind)
+
+
+class Expr:
+    """
+    Node in an image expression.
+
+    Operations return new expressions; nothing is read or calculated
+    until the expression is evaluated.
+    """
+
+    def __init__(self, op, args=(), params=()):
+        self.op = op
+        self.args = tuple(args)
+        self.params = tuple(params)
+        if op in reductions:
+            self.is4d = False
+        else:
+            self.is4d = any(arg.is4d for arg in self.args)
+
+    def _binary(self, op, other):
+        if isinstance(other, Expr):
+            return Expr(op, (self, other))
+        return Expr(op, (self,), (float(other),))
+
+    def thr(self, value):
+        """Zero values below a threshold."""
+        return Expr("thr", (self,), (value,))
+
+    def uthr(self, value):
+        """Zero values above a threshold."""
+        return Expr("uthr", (self,), (value,))
+
+    def bin(self):
+        """Set positive values to one and others to zero."""
+        return Expr("bin", (self,))
+
+    def abs(self):
+        return Expr("abs", (self,))
+
+    def add(self, other):
+        return self._binary("add", other)
+
+    def sub(self, other):
+        return self._binary("sub", other)
+
+    def mul(self, other):
+        return self._binary("mul", other)
+
+    def div(self, other):
+        """Divide by an image or number; division by zero gives zero."""
+        return self._binary("div", other)
+
+    def mas(self, mask):
+        """Zero voxels where a mask is not positive."""
+        return Expr("mas", (self, mask))
+
+    def fillh26(self):
+        """Binarize and fill holes, using 26-connectivity."""
+        return Expr("fillh26", (self,))
+
+    def dild(self, kernel):
+        """Set zero voxels to the most common non-zero value in a kernel."""
+        return Expr("dilD", (self,), (kernel,))
+
+    def tmean(self):
+        return Expr("Tmean", (self,))
+
+    def tmax(self):
+        return Expr("Tmax", (self,))
+
+    def tmin(self):
+        return Expr("Tmin", (self,))
+
+    def sources(self):
+        """Input images used by the expression, in order of first use."""
+        found = []
+        for node in walk([self]):
+            if isinstance(node, Source) and node not in found:
+                found.append(node)
+        return found
+
+
+class Source(Expr):
+    """Image read from a file."""
+
+    def __init__(self, filepath):
+        self.filepath = os.path.abspath(filepath)
+        self.img = image.load(self.filepath)
+        self.data = image.get_source(self.img)
+        self.op = "source"
+        self.args = ()
+        self.params = ()
+        self.is4d = len(self.img.shape) > 3
+
+
+def read(filepath):
+    """Start an expression from an image file."""
+    return Source(filepath)
+
+
+def walk(exprs):
+    """All nodes of a set of expressions, with arguments before users."""
+    order = []
+    seen = set()
+
+    def visit(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for arg in node.args:
+            visit(arg)
+        order.append(node)
+
+    for expr in exprs:
+        visit(expr)
+    return order
+
+
+def level(node, cache):
+    """Number of passes over 4D data needed before a node can be calculated."""
+    if id(node) not in cache:
+        levels = [level(arg, cache) for arg in node.args]
+        n = max(levels) if levels else 0
+        if node.op in reductions and node.args[0].is4d:
+            n += 1
+        cache[id(node)] = n
+    return cache[id(node)]
+
+
+def align(values):
+    """Add a time dimension to 3D arrays used with 4D arrays."""
+    if any(np.ndim(v) == 4 for v in values):
+        return [v[..., None] if np.ndim(v) == 3 else v for v in values]
+    return values
+
+
+def cast(data, dtype):
+    """Convert data to an output type, rounding to integers if needed."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    return data.astype(dtype)
+
+
+class ImageWriter:
+    """
+    Write a NIfTI image a block of volumes at a time.
+
+    Data are written to a temporary file, which replaces the output file
+    when commit is called. This allows an output to overwrite one of
+    the inputs.
+    """
+
+    def __init__(self, filepath, header, shape, dtype):
+        from nibabel.openers import ImageOpener
+
+        # copy all fields of the source header except extensions, which
+        # would change the data offset
+        hdr = nib.Nifti1Header.from_header(header)
+        hdr.extensions.clear()
+        hdr["magic"] = b"n+1"
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(dtype)
+        hdr.set_slope_inter(1, 0)
+        hdr.set_data_offset(352)
+        self.dtype = np.dtype(dtype)
+        self.filepath = filepath
+        dirname, basename = os.path.split(filepath)
+        self.temp_file = os.path.join(dirname, ".tmp%d_%s" % (os.getpid(), basename))
+        self.file = ImageOpener(self.temp_file, "wb")
+        hdr.write_to(self.file)
+        self.file.write(b"\0" * (352 - self.file.tell()))
+
+    def write(self, data):
+        """Write volumes, which must be in order."""
+        data = cast(data, self.dtype)
+        self.file.write(data.tobytes(order="F"))
+
+    def close(self):
+        self.file.close()
+
+    def commit(self):
+        """Move the finished image to the output file."""
+        os.replace(self.temp_file, self.filepath)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp_file):
+            os.remove(self.temp_file)
+
+
+class Evaluator:
+    """
+    Evaluate expressions and write them to files in as few passes as possible.
+
+    Outputs that do not depend on 4D data, and temporal reductions of 4D
+    data, are calculated once. Other outputs are calculated a block of
+    volumes at a time. An expression that uses a temporal reduction of
+    4D data with 4D data needs an additional pass. Each pass reads the
+    blocks of each image in order from one open file, so compressed
+    images are decompressed once per pass.
+    """
+
+    def __init__(self, outputs, max_memory=512):
+        self.outputs = outputs
+        self.max_memory = max_memory
+        self.static = {}
+        self.reduced = {}
+        self.nodes = walk([expr for expr, filepath, dtype in outputs])
+
+        shapes = set()
+        n_vols = set()
+        for node in self.nodes:
+            if isinstance(node, Source):
+                shapes.add(node.img.shape[:3])
+                if node.is4d:
+                    n_vols.add(node.img.shape[3])
+        if len(shapes) > 1 or len(n_vols) > 1:
+            raise ValueError("Input images have different dimensions: %s" % shapes)
+        self.n_vols = n_vols.pop() if n_vols else 1
+        self.shape = shapes.pop()
+
+    def chunk_size(self):
+        """Number of volumes to process at once."""
+        n_arrays = sum(node.is4d for node in self.nodes) + 1
+        per_volume = int(np.prod(self.shape)) * 4 * n_arrays
+        n = int(self.max_memory * 1024 ** 2 // per_volume)
+        return max(1, min(n, self.n_vols))
+
+    def value(self, node, block, memo):
+        """Value of a node for a block of volumes."""
+        # images used more than once are read once
+        key = node.filepath if isinstance(node, Source) else id(node)
+        if key in self.static:
+            return self.static[key]
+        if key in memo:
+            return memo[key]
+
+        if node.op == "source":
+            if node.is4d:
+                result = image.read_volumes(node.data, *block)
+            else:
+                result = np.asarray(image.get_data(node.img), dtype=np.float32)
+        elif node.op in reductions:
+            if not node.args[0].is4d:
+                result = self.value(node.args[0], block, memo)
+            elif key in self.reduced:
+                result = self.reduced[key]
+            else:
+                raise RuntimeError("Reduction used before it was calculated.")
+        else:
+            values = [self.value(arg, block, memo) for arg in node.args]
+            if node.op in elementwise:
+                values = align(values)
+                result = elementwise[node.op](*values, *node.params)
+            elif node.op in spatial:
+                func = spatial[node.op]
+                data = values[0]
+                if data.ndim == 4:
+                    result = np.stack(
+                        [
+                            func(data[..., i], *node.params)
+                            for i in range(data.shape[3])
+                        ],
+                        axis=3,
+                    )
+                else:
+                    result = func(data, *node.params)
+            else:
+                raise ValueError("Unknown operation: %s" % node.op)
+            result = np.asarray(result, dtype=np.float32)
+
+        if node.is4d:
+            memo[key] = result
+        else:
+            self.static[key] = result
+        return result
+
+    def run(self):
+        """Evaluate and write all outputs."""
+        levels = {}
+        n_passes = 0
+        for node in self.nodes:
+            if node.is4d:
+                n_passes = max(n_passes, level(node, levels) + 1)
+
+        chunk = self.chunk_size()
+        finished = []
+        try:
+            for i in range(n_passes):
+                finished += self.run_pass(i, levels, chunk)
+
+            # outputs that do not vary over time
+            for expr, filepath, dtype in self.outputs:
+                if not expr.is4d:
+                    data = self.value(expr, None, {})
+                    writer = ImageWriter(filepath, self.header(expr), self.shape, dtype)
+                    finished.append(writer)
+                    writer.write(data)
+                    writer.close()
+        except BaseException:
+            for writer in finished:
+                writer.discard()
+            raise
+
+        # replace outputs only after all inputs have been read
+        for writer in finished:
+            writer.commit()
+
+    def run_pass(self, i, levels, chunk):
+        """Make one pass over 4D data; return writers for finished outputs."""
+        # 4D outputs and temporal reductions that can be done this pass
+        outputs = [
+            (expr, filepath, dtype)
+            for expr, filepath, dtype in self.outputs
+            if expr.is4d and level(expr, levels) == i
+        ]
+        reduce = [
+            node
+            for node in self.nodes
+            if node.op in reductions
+            and node.args[0].is4d
+            and level(node.args[0], levels) == i
+        ]
+        shape = self.shape + (self.n_vols,)
+        writers = []
+        totals = {}
+        try:
+            for expr, filepath, dtype in outputs:
+                writers.append(ImageWriter(filepath, self.header(expr), shape, dtype))
+            for start in range(0, self.n_vols, chunk):
+                block = (start, min(start + chunk, self.n_vols))
+                memo = {}
+                for (expr, filepath, dtype), writer in zip(outputs, writers):
+                    writer.write(self.value(expr, block, memo))
+                for node in reduce:
+                    data = self.value(node.args[0], block, memo)
+                    self.accumulate(node, data, totals)
+            for writer in writers:
+                writer.close()
+        except BaseException:
+            for writer in writers:
+                writer.discard()
+            raise
+
+        for node in reduce:
+            result = totals[id(node)]
+            if node.op == "Tmean":
+                result = result / self.n_vols
+            self.reduced[id(node)] = result.astype(np.float32)
+        return writers
+
+    def accumulate(self, node, data, totals):
+        """Update a temporal reduction with a block of volumes."""
+        key = id(node)
+        if node.op == "Tmean":
+            block = np.sum(data, axis=3, dtype=np.float64)
+            totals[key] = totals[key] + block if key in totals else block
+        elif node.op == "Tmax":
+            block = np.max(data, axis=3)
+            totals[key] = np.maximum(totals[key], block) if key in totals else block
+        elif node.op == "Tmin":
+            block = np.min(data, axis=3)
+            totals[key] = np.minimum(totals[key], block) if key in totals else block
+
+    def header(self, expr):
+        """
+        Header for an output, from the first image in its expression.
+
+        If the output is 4D but the first image is 3D, voxel sizes,
+        units, and TR are taken from the first 4D image.
+        """
+        sources = expr.sources()
+        hdr = nib.Nifti1Header.from_header(sources[0].img.header)
+        if expr.is4d and not sources[0].is4d:
+            hdr4d = next(node for node in sources if node.is4d).img.header
+            hdr.set_data_shape(hdr4d.get_data_shape())
+            hdr.set_zooms(hdr4d.get_zooms())
+            hdr.set_xyzt_units(*hdr4d.get_xyzt_units())
+            hdr["toffset"] = hdr4d["toffset"]
+        return hdr
+
+
+def evaluate(outputs, max_memory=512):
+    """
+    Evaluate expressions and write them to image files.
+
+    Outputs is a list of (expression, filepath) or (expression, filepath,
+    dtype) tuples. By default, each output has the data type of the first
+    image in its expression, as in fslmaths. max_memory (in MB) limits
+    the size of blocks of volumes read from 4D images.
+    """
+    full = []
+    for output in outputs:
+        expr, filepath = output[:2]
+        if len(output) > 2 and output[2] is not None:
+            dtype = output[2]
+        else:
+            dtype = expr.sources()[0].img.get_data_dtype()
+        full.append((expr, filepath, np.dtype(dtype)))
+    Evaluator(full, max_memory).run()
+
+
+def image_file(name):
+    """Find an image file, allowing the extension to be left off."""
+    if os.path.exists(name):
+        return name
+    for ext in [".nii.gz", ".nii"]:
+        if os.path.exists(name + ext):
+            return name + ext
+    raise IOError("Image not found: %s" % name)
+
+
+def output_file(name):
+    """Path to an output image, adding an extension if needed."""
+    if name.endswith((".nii", ".nii.gz")):
+        return name
+    return name + ".nii.gz"
+
+
+def parse_number(token):
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+
+# operations that take an argument
+binary_ops = ["add", "sub", "mul", "div", "mas"]
+scalar_ops = ["thr", "uthr"]
+unary_ops = ["bin", "abs", "fillh26", "dilD", "Tmean", "Tmax", "Tmin"]
+
+
+def parse_expression(tokens):
+    """
+    Parse fslmaths-style arguments into a list of outputs.
+
+    Each chain starts with an input image and is followed by operations
+    and output images. Operations after an output continue from the
+    value that was written. Chains are separated by a comma, and images
+    written earlier may be used as inputs without being read again.
+    """
+    outputs = []
+    named = {}
+    expr = None
+    kernel = make_kernel("3D")
+    kernel_spec = None
+
+    def operand(token):
+        value = parse_number(token)
+        if value is not None:
+            return value
+        path = os.path.abspath(output_file(token))
+        if path in named:
+            return named[path]
+        return read(image_file(token))
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token == ",":
+            expr = None
+            continue
+        if expr is None:
+            expr = operand(token)
+            if not isinstance(expr, Expr):
+                raise ValueError("Chains must start with an image: %s" % token)
+            if kernel_spec is not None:
+                kernel = make_kernel(
+                    *kernel_spec, zooms=expr.sources()[0].img.header.get_zooms()
+                )
+            continue
+
+        if not token.startswith("-") or parse_number(token) is not None:
+            # output image
+            path = os.path.abspath(output_file(token))
+            outputs.append([expr, path, None])
+            named[path] = expr
+            continue
+
+        op = token[1:]
+        if op == "odt":
+            if not outputs:
+                raise ValueError("-odt must follow an output image.")
+            dtype = tokens[i]
+            i += 1
+            if dtype != "input":
+                outputs[-1][2] = data_types[dtype]
+        elif op == "kernel":
+            kind = tokens[i]
+            i += 1
+            size = None
+            if kind != "3D":
+                size = float(tokens[i])
+                i += 1
+            kernel_spec = (kind, size)
+            kernel = make_kernel(
+                kind, size, zooms=expr.sources()[0].img.header.get_zooms()
+            )
+        elif op in binary_ops:
+            other = operand(tokens[i])
+            i += 1
+            expr = getattr(expr, op)(other)
+        elif op in scalar_ops:
+            expr = getattr(expr, op)(float(tokens[i]))
+            i += 1
+        elif op == "dilD":
+            expr = expr.dild(kernel)
+        elif op in unary_ops:
+            expr = getattr(expr, op.lower())()
+        else:
+            raise ValueError("Unknown operation: %s" % token)
+    if not outputs:
+        raise ValueError("No output image specified.")
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calculate images using fslmaths-style operations.",
+        epilog="Operations: %s; -kernel {3D,box,boxv,sphere} [size]; "
+        "-odt {char,short,int,float,double,input} after an output. Any "
+        "number of outputs may be written; operations after an output "
+        "continue from its value. Separate chains that start from a "
+        "different image with a comma. All outputs are calculated with one "
+        "read of each input."
+        % ", ".join("-" + op for op in scalar_ops + binary_ops + unary_ops),
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=512,
+        help="MB of volumes to process at once (default: 512)",
+    )
+    parser.add_argument(
+        "expression",
+        nargs=argparse.REMAINDER,
+        help="input image, operations, and output images",
+    )
+    args = parser.parse_args()
+    if not args.expression:
+        parser.error("no expression specified")
+    try:
+        outputs = parse_expression(args.expression)
+    except (ValueError, IOError, IndexError, KeyError) as err:
+        parser.error(str(err))
+    evaluate(outputs, args.max_memory)
@@ -0,0 +1,161 @@
+"""Timing and memory use of processing stages."""
+
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+import tracemalloc
+
+_null_stage = contextlib.nullcontext()
+_profiler = None
+
+
+def env_enabled():
+    """Check whether profiling is requested by the FPREP_PROFILE variable."""
+    return os.environ.get("FPREP_PROFILE", "").lower() not in ("", "0", "false", "no")
+
+
+def current_rss():
+    """Current resident set size in MB, if available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def max_rss():
+    """Peak resident set size of the process in MB, if available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxrss / 1024 ** 2
+    return maxrss / 1024
+
+
+class Profiler:
+    """
+    Record wall time, CPU time, and memory use of named stages.
+
+    Stages may be nested. Peak traced memory is measured with tracemalloc
+    for each stage, including any stages nested within it. If outfile is
+    set, records are saved whenever a top-level stage starts or finishes,
+    so the stage that was running is known even if the process is
+    killed.
+    """
+
+    def __init__(self, outfile=None, trace_memory=True):
+        self.outfile = outfile
+        self.trace_memory = trace_memory
+        self.records = []
+        self.stack = []
+        self.started_tracing = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.save()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # peak so far belongs to the enclosing stage
+            peak = tracemalloc.get_traced_memory()[1]
+            if self.stack:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+
+        record = {
+            "stage": "/".join([s["stage"] for s in self.stack] + [name]),
+            "status": "running",
+        }
+        frame = {
+            "stage": name,
+            "peak": 0,
+            "wall": time.perf_counter(),
+            "cpu": time.process_time(),
+        }
+        self.stack.append(frame)
+        self.records.append(record)
+        if len(self.stack) == 1:
+            self.save()
+        try:
+            yield
+            record["status"] = "ok"
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            self.stack.pop()
+            record["wall_s"] = time.perf_counter() - frame["wall"]
+            record["cpu_s"] = time.process_time() - frame["cpu"]
+            if tracing and tracemalloc.is_tracing():
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                record["peak_traced_mb"] = peak / 1024 ** 2
+                if self.stack:
+                    self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+                tracemalloc.reset_peak()
+            record["rss_mb"] = current_rss()
+            record["max_rss_mb"] = max_rss()
+            if not self.stack:
+                self.save()
+
+    def save(self):
+        """Save stage records to the output file."""
+        if self.outfile is None:
+            return
+        with open(self.outfile, "w") as f:
+            json.dump({"stages": self.records}, f, indent=2)
+
+
+def stage(name):
+    """Context manager for a named stage; does nothing if profiling is off."""
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name)
+
+
+def profiled(func):
+    """Decorator to record each call of a function as a stage."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return func(*args, **kwargs)
+        with _profiler.stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile(outfile=None, trace_memory=True):
+    """Enable profiling within a block, optionally saving to a JSON file."""
+    global _profiler
+    if _profiler is not None:
+        # already profiling; stages are added to the active profiler
+        yield _profiler
+        return
+
+    _profiler = Profiler(outfile, trace_memory)
+    _profiler.start()
+    try:
+        yield _profiler
+    finally:
+        profiler = _profiler
+        _profiler = None
+        profiler.stop()
@@ -1,13 +1,30 @@
 """Quality assurance tools from fmriqa."""
 
 import os
+import sys
 import time
+import ctypes
+import hashlib
+import zipfile
 import numpy as np
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
-from reportlab.pdfgen import canvas
+from fprep import image
+from fprep import profiling
 
 
+def load_pyplot():
+    """Import pyplot with a non-interactive backend."""
+    flags = sys.getdlopenflags()
+    sys.setdlopenflags(flags | ctypes.RTLD_GLOBAL)
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    sys.setdlopenflags(flags)
+    return plt
+
+
+@profiling.profiled
 def compute_fd(motpars):
     # compute absolute displacement
     dmotpars = np.zeros(motpars.shape)
@@ -30,77 +47,162 @@ def compute_fd(motpars):
     return FD
 
 
-def mk_slice_mosaic(
-    imgdata, outfile, title, contourdata=None, ncols=6, colorbar=True, verbose=False
-):
-    if imgdata.shape[0] == imgdata.shape[1] == imgdata.shape[2]:
-        min_dim = 2
+def detrend_basis(ntp, order=1):
+    """
+    Orthonormal polynomial basis for removing temporal trends.
+
+    Spans the same space as the design used by statsmodels detrend, so
+    projecting it out gives the same residuals for every voxel.
+    """
+    X = np.vander(np.arange(ntp, dtype=np.float64), order + 1)
+    basis, _ = np.linalg.qr(X)
+    return basis
+
+
+@profiling.profiled
+def detrend_zscore(data, order=1, blocksize=10000):
+    """
+    Detrend and z-score each row of a (voxels x time) matrix in place.
+
+    Voxels are processed in blocks of rows to limit the size of
+    temporary arrays.
+    """
+    basis = detrend_basis(data.shape[1], order)
+    for start in range(0, data.shape[0], blocksize):
+        block = data[start : start + blocksize]
+        block -= (block @ basis) @ basis.T
+        block -= np.mean(block, 1, keepdims=True)
+        block /= np.std(block, 1, keepdims=True)
+    return data
+
+
+@profiling.profiled
+def slice_aaz(zscore, slices, nslices, slice_size):
+    """
+    Average absolute Z-score for each slice and timepoint.
+
+    zscore is a (voxels x time) matrix with voxels sorted by slice, and
+    slices gives the slice index of each voxel. Voxels outside the
+    matrix are taken to have a Z-score of zero, so each sum is divided
+    by the total number of voxels in a slice (slice_size).
+    """
+    counts = np.bincount(slices, minlength=nslices)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    AAZ = np.zeros((nslices, zscore.shape[1]))
+    for s in np.nonzero(counts)[0]:
+        AAZ[s] = np.sum(np.abs(zscore[bounds[s] : bounds[s + 1]]), 0)
+    AAZ /= slice_size
+    return AAZ
+
+
+@profiling.profiled
+def jackknife_z(AAZ):
+    """
+    Jackknife Z-score of each slice relative to the other slices.
+
+    For each timepoint, the mean and standard deviation of the other
+    slices are calculated from column sums and sums of squares with the
+    left-out slice removed.
+    """
+    n = AAZ.shape[0] - 1
+    # center each column to limit round-off in the sums of squares
+    centered = AAZ - np.mean(AAZ, 0)
+    total = np.sum(centered, 0)
+    total_sq = np.sum(centered ** 2, 0)
+    train_mean = (total - centered) / n
+    train_var = (total_sq - centered ** 2) / n - train_mean ** 2
+    train_std = np.sqrt(np.maximum(train_var, 0))
+    JKZ = (centered - train_mean) / train_std
+    return JKZ
+
+
+def slice_mosaic(imgdata, ncols=6):
+    """
+    Tile the slices of a volume into a 2D mosaic.
+
+    Slices are taken along the smallest spatial dimension (the last one
+    for cubes) and laid out in rows of ncols, with the last row padded
+    with zeros. If imgdata is 4D, volumes are stacked along the last
+    dimension and one mosaic is made for each volume in the same pass.
+    """
+    data = np.asarray(imgdata)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+
+    shape = data.shape[:3]
+    if shape[0] == shape[1] == shape[2]:
+        slice_dim = 2
+    else:
+        slice_dim = int(np.argmin(shape))
+
+    # arrange as (slice, row, column, volume), flipping so that the
+    # superior/anterior side of each slice is at the top
+    if slice_dim == 0:
+        stack = data[:, :, ::-1].transpose(0, 2, 1, 3)
+    elif slice_dim == 1:
+        stack = data[:, :, ::-1].transpose(1, 2, 0, 3)
     else:
-        min_dim = np.where(np.min(imgdata.shape[0:3]) == imgdata.shape[0:3])[0][0]
-        slice_dims = np.where(np.min(imgdata.shape[0:3]) != imgdata.shape[0:3])[0]
-        if verbose:
-            print("min_dim:", min_dim)
-            print("slice_dim:", slice_dims)
-
-    nrows = int(np.ceil(np.float(imgdata.shape[min_dim]) / ncols))
-    mosaic = np.zeros(
-        (nrows * imgdata.shape[slice_dims[0]], ncols * imgdata.shape[slice_dims[1]])
+        stack = data[:, ::-1].transpose(2, 1, 0, 3)
+
+    nslices, height, width, nvols = stack.shape
+    nrows = int(np.ceil(nslices / ncols))
+    tiles = np.zeros((nrows * ncols, height, width, nvols))
+    tiles[:nslices] = stack
+    mosaic = (
+        tiles.reshape(nrows, ncols, height, width, nvols)
+        .transpose(0, 2, 1, 3, 4)
+        .reshape(nrows * height, ncols * width, nvols)
     )
+    if np.ndim(imgdata) == 3:
+        mosaic = mosaic[..., 0]
+    return mosaic
+
+
+@profiling.profiled
+def mk_slice_mosaics(
+    images, outfiles, titles, contourdata=None, contour=None, ncols=6, colorbar=True
+):
+    """
+    Plot slice mosaics for multiple volumes.
+
+    All volumes (and the contour volume, if specified) are tiled in one
+    pass and plotted using a shared figure. If contourdata is specified,
+    it is outlined on the images indicated by contour (default: all).
+    """
+    plt = load_pyplot()
+
+    volumes = list(images)
     if contourdata is not None:
-        contourmosaic = np.zeros(
-            (nrows * imgdata.shape[slice_dims[0]], ncols * imgdata.shape[slice_dims[1]])
-        )
-    ctr = 0
+        volumes.append(contourdata)
+        if contour is None:
+            contour = [True] * len(images)
+    mosaics = slice_mosaic(np.stack(volumes, axis=3), ncols)
+
+    fig = plt.figure(figsize=(8, 8))
+    for i, (outfile, title) in enumerate(zip(outfiles, titles)):
+        fig.clf()
+        plt.imshow(mosaics[..., i], cmap=plt.cm.gray)
+        if not title == "":
+            plt.title(title)
+        if colorbar:
+            plt.colorbar()
+        if contourdata is not None and contour[i]:
+            plt.contour(mosaics[..., -1], colors="red")
+        plt.savefig(outfile, bbox_inches="tight")
+    plt.close(fig)
+
+
+def mk_slice_mosaic(
+    imgdata, outfile, title, contourdata=None, ncols=6, colorbar=True, verbose=False
+):
     if verbose:
-        print(mosaic.shape)
-
-    for row in range(nrows):
-        rowstart = row * imgdata.shape[slice_dims[0]]
-        rowend = (row + 1) * imgdata.shape[slice_dims[0]]
-        for col in range(ncols):
-            if ctr < imgdata.shape[min_dim]:
-                colstart = col * imgdata.shape[slice_dims[1]]
-                colend = (col + 1) * imgdata.shape[slice_dims[1]]
-                if verbose:
-                    print(rowstart, rowend, colstart, colend)
-                if min_dim == 0:
-                    imgslice = imgdata[ctr, :, ::-1].T
-                    if contourdata is not None:
-                        contourslice = contourdata[ctr, :, ::-1].T
-                elif min_dim == 1:
-                    imgslice = imgdata[:, ctr, ::-1].T
-                    if contourdata is not None:
-                        contourslice = contourdata[:, ctr, ::-1].T
-                elif min_dim == 2:
-                    imgslice = imgdata[:, ::-1, ctr].T
-                    if contourdata is not None:
-                        contourslice = contourdata[:, ::-1, ctr].T
-                if verbose:
-                    print(imgslice.shape)
-                try:
-                    mosaic[rowstart:rowend, colstart:colend] = imgslice
-                except:
-                    mosaic[rowstart:rowend, colstart:colend] = imgslice.T
-
-                if contourdata is not None:
-                    try:
-                        contourmosaic[rowstart:rowend, colstart:colend] = contourslice
-                    except:
-                        contourmosaic[rowstart:rowend, colstart:colend] = contourslice.T
-                ctr += 1
-
-    plt.figure(figsize=(8, 8))
-    plt.imshow(mosaic, cmap=plt.cm.gray)
-    if not title == "":
-        plt.title(title)
-    if colorbar:
-        plt.colorbar()
-    if contourdata is not None:
-        plt.contour(contourmosaic, colors="red")
-    plt.savefig(outfile, bbox_inches="tight")
-    plt.close()
+        print("mosaic shape:", slice_mosaic(imgdata, ncols).shape)
+    mk_slice_mosaics(
+        [imgdata], [outfile], [title], contourdata, ncols=ncols, colorbar=colorbar
+    )
 
 
+@profiling.profiled
 def plot_timeseries(
     data,
     title,
@@ -113,6 +215,12 @@ def plot_timeseries(
     xlabel="timepoints",
     ylabel=None,
 ):
+    """
+    Plot a timeseries.
+
+    outfile may be a file path or a writable buffer such as io.BytesIO.
+    """
+    plt = load_pyplot()
     fig = plt.figure(figsize=[10, 3])
     fig.subplots_adjust(bottom=0.15)
     plt.plot(data)
@@ -137,6 +245,8 @@ def plot_timeseries(
                 np.arange(ntp) ** 2 - np.mean(np.arange(ntp) ** 2),
             )
         ).T
+        import statsmodels.api as sm
+
         model = sm.OLS(data, X)
         results = model.fit()
 
@@ -165,6 +275,37 @@ def plot_timeseries(
         return []
 
 
+@profiling.profiled
+def plot_psd(data, TR, outfile):
+    """Plot the log power spectrum of a timeseries."""
+    plt = load_pyplot()
+    from matplotlib import mlab
+
+    psd = mlab.psd(data, NFFT=128, noverlap=96, Fs=1 / TR)
+
+    fig = plt.figure(figsize=[10, 3])
+    fig.subplots_adjust(bottom=0.15)
+    plt.plot(psd[1][2:], np.log(psd[0][2:]))
+    plt.title("Log power spectrum of mean signal across mask")
+    plt.xlabel("frequency (secs)")
+    plt.ylabel("log power")
+    plt.savefig(outfile, bbox_inches="tight")
+    plt.close()
+
+
+@profiling.profiled
+def plot_spikes(AJKZ, vmax, outfile):
+    """Plot the spike measure for each slice and timepoint."""
+    plt = load_pyplot()
+    plt.figure()
+    plt.imshow(AJKZ, vmin=0, vmax=vmax)
+    plt.xlabel("timepoints")
+    plt.ylabel("slices")
+    plt.title("Spike measure (absolute jackknife Z)")
+    plt.savefig(outfile, bbox_inches="tight")
+    plt.close()
+
+
 def MAD(a, c=0.6745, axis=0):
     """
     Median Absolute Deviation along given axis of an array:
@@ -172,27 +313,232 @@ def MAD(a, c=0.6745, axis=0):
     median(abs(a - median(a))) / c
 
     c = 0.6745 is the constant to convert from MAD to std; it is used by
-    default
+    default. NaNs are ignored.
 
     from http://code.google.com/p/agpy/source/browse/trunk/agpy/mad.py?r=206
     """
-    good = a == a
     a = np.asarray(a, np.float64)
-    if a.ndim == 1:
-        d = np.median(a[good])
-        m = np.median(np.fabs(a[good] - d) / c)
+    if np.isnan(a).any():
+        median = np.nanmedian
     else:
-        d = np.median(a[good], axis=axis)
-        # I don't want the array to change so I have to copy it?
-        if axis > 0:
-            aswp = np.swapaxes(a[good], 0, axis)
-        else:
-            aswp = a[good]
-        m = np.median(np.fabs(aswp - d) / c, axis=0)
+        median = np.median
+    d = median(a, axis=axis, keepdims=True)
+    m = median(np.fabs(a - d) / c, axis=axis)
     return m
 
 
-def mk_report(infile, qadir, datavars):
+@profiling.profiled
+def mask_stats(brain, nonbrain):
+    """
+    Statistics for each volume within and outside a brain mask.
+
+    brain and nonbrain are (voxels x time) matrices. Returns the median,
+    MAD, mean, and coefficient of variation of the brain voxels and the
+    signal-to-noise ratio relative to the non-brain voxels, each with
+    one value per timepoint.
+    """
+    maskmedian = np.median(brain, 0)
+    maskmad = MAD(brain, axis=0)
+    maskmean = np.mean(brain, 0)
+    maskcv = maskmad / maskmedian
+    imgsnr = maskmean / np.std(nonbrain, 0, dtype=np.float64)
+    return maskmedian, maskmad, maskmean, maskcv, imgsnr
+
+
+def chunk_volumes(shape, nmaskvox, max_memory):
+    """
+    Number of volumes to process at once within a memory limit.
+
+    max_memory is in megabytes and covers both the per-chunk arrays and
+    the statistics accumulated over the whole run.
+    """
+    nvox = int(np.prod(shape[:3]))
+    ntp = shape[3]
+    # running voxel mean and variance, plus per-voxel trend fits
+    fixed = nvox * 16 + nmaskvox * 40 + ntp * 100
+    # float32 chunk, float64 voxel deviations and brain copies
+    per_volume = nvox * 16 + nmaskvox * 24
+    available = max_memory * 1024 ** 2 - fixed
+    if available < per_volume:
+        raise ValueError(
+            "Memory limit of %d MB is too small for images of size %s."
+            % (max_memory, shape)
+        )
+    return int(min(ntp, available // per_volume))
+
+
+@profiling.profiled
+def chunked_stats(img, maskvox, nonmaskvox, chunk_size, order=1):
+    """
+    Calculate voxel, volume, and spike statistics in chunks of volumes.
+
+    Volumes are read as float32 in chunks of chunk_size; memory-mapped
+    float32 images are used without copying. A first pass
+    accumulates voxel means and variances, per-volume mask statistics,
+    and per-voxel trend fits; a second pass uses the fits to compute
+    detrended Z-scores and sum them into the AAZ matrix. Returns a dict
+    with voxmean, voxstd, maskmedian, maskmad, maskmean, maskcv, imgsnr,
+    and AAZ.
+    """
+    shape = img.shape
+    nslices = shape[2]
+    ntp = shape[3]
+    basis = detrend_basis(ntp, order)
+    chunks = [(t, min(t + chunk_size, ntp)) for t in range(0, ntp, chunk_size)]
+
+    source = image.get_source(img)
+
+    def read_chunk(start, finish):
+        return image.read_volumes(source, start, finish, dtype=np.float32)
+
+    voxmean = np.zeros(shape[:3])
+    voxm2 = np.zeros(shape[:3])
+    volstats = []
+    coef = np.zeros((len(maskvox[0]), basis.shape[1]))
+    sumsq = np.zeros(len(maskvox[0]))
+    ref = None
+    for start, finish in chunks:
+        chunk = read_chunk(start, finish)
+        n = finish - start
+
+        # merge mean and sum of squared deviations for this chunk
+        chunk_mean = np.mean(chunk, 3, dtype=np.float64)
+        dev = chunk - chunk_mean[..., None]
+        chunk_m2 = np.sum(np.square(dev, out=dev), 3)
+        del dev
+        delta = chunk_mean - voxmean
+        voxmean += delta * n / finish
+        voxm2 += chunk_m2 + delta ** 2 * start * n / finish
+
+        brain = chunk[maskvox].astype(np.float64)
+        nonbrain = chunk[nonmaskvox]
+        del chunk
+        volstats.append(mask_stats(brain, nonbrain))
+        del nonbrain
+
+        # trend fit is unchanged by a constant offset, so subtract the
+        # first volume to limit round-off in the sums of squares
+        if ref is None:
+            ref = brain[:, :1].copy()
+        brain -= ref
+        coef += brain @ basis[start:finish]
+        sumsq += np.einsum("ij,ij->i", brain, brain)
+        del brain
+
+    # residual standard deviation after projecting out the trend
+    voxres = np.sqrt(np.maximum(sumsq - np.sum(coef ** 2, 1), 0) / ntp)
+    AAZ = np.zeros((nslices, ntp))
+    for start, finish in chunks:
+        brain = read_chunk(start, finish)[maskvox].astype(np.float64)
+        brain -= ref
+        brain -= coef @ basis[start:finish].T
+        brain /= voxres[:, None]
+        AAZ[:, start:finish] = slice_aaz(
+            brain, maskvox[2], nslices, shape[0] * shape[1]
+        )
+        del brain
+
+    stats = {
+        "voxmean": voxmean,
+        "voxstd": np.sqrt(voxm2 / ntp),
+        "AAZ": AAZ,
+    }
+    names = ["maskmedian", "maskmad", "maskmean", "maskcv", "imgsnr"]
+    for name, values in zip(names, zip(*volstats)):
+        stats[name] = np.concatenate(values)
+    return stats
+
+
+# increment when the cached statistics change
+cache_version = 2
+
+
+def fingerprint(files):
+    """
+    Key for a set of input files, from their size and modification time.
+
+    As in incremental mode, files with unchanged size and modification
+    time are taken to be unchanged, so that files are not read just to
+    check the cache.
+    """
+    h = hashlib.sha1(b"fprep-qa-%d" % cache_version)
+    for filepath in files:
+        st = os.stat(filepath)
+        state = "%s\0%d\0%d\0" % (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+        h.update(state.encode())
+    return h.hexdigest()
+
+
+def load_cache(cachefile, key):
+    """
+    Load cached QA statistics.
+
+    Returns a dict of arrays, or None if there is no cache or it was
+    made from different inputs.
+    """
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        with np.load(cachefile) as f:
+            if str(f["key"]) != key:
+                return None
+            return {name: f[name] for name in f.files if name != "key"}
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # unreadable or truncated cache; statistics will be recalculated
+        return None
+
+
+def save_cache(cachefile, key, stats):
+    """
+    Save QA statistics, keyed by a fingerprint of the inputs.
+
+    The cache is written to a temporary file and then moved into place,
+    so that an interrupted write does not leave a partial cache.
+    """
+    tempfile = "%s.%d.tmp.npz" % (cachefile, os.getpid())
+    np.savez(tempfile, key=key, **stats)
+    os.replace(tempfile, cachefile)
+
+
+# images included in the QA report
+report_images = [
+    "maskmean.png",
+    "meanpsd.png",
+    "mad.png",
+    "DVARS.png",
+    "fd.png",
+    "spike.png",
+    "voxmean.png",
+    "voxsfnr.png",
+    "voxcv.png",
+]
+
+
+def save_images(images, qadir):
+    """Write in-memory images to files in a directory."""
+    for name, buf in images.items():
+        with open(os.path.join(qadir, name), "wb") as f:
+            f.write(buf.getvalue())
+
+
+@profiling.profiled
+def mk_report(infile, qadir, datavars, images=None):
+    """
+    Create a PDF report of QA results.
+
+    Images are drawn from in-memory buffers in images (a dict of
+    io.BytesIO with keys from report_images) if specified; otherwise,
+    PNG files are read from qadir.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+
+    def get_image(name):
+        if images is None:
+            return os.path.join(qadir, name)
+        images[name].seek(0)
+        return ImageReader(images[name])
+
     timestamp = time.strftime("%B %d, %Y: %H:%M:%S")
 
     report_header = []
@@ -224,25 +570,23 @@ def mk_report(infile, qadir, datavars):
         "fd.png",
     ]
 
-    tsfiles = [os.path.join(qadir, t) for t in timeseries_to_draw]
-
     ts_img_size = [467, 140]
     yloc = yloc - ts_img_size[1]
 
-    for imfile in tsfiles:
-        c.drawImage(imfile, 45, yloc, width=ts_img_size[0], height=ts_img_size[1])
+    for name in timeseries_to_draw:
+        c.drawImage(
+            get_image(name), 45, yloc, width=ts_img_size[0], height=ts_img_size[1]
+        )
         yloc = yloc - ts_img_size[1]
 
     c.showPage()
 
     yloc = 650
-    c.drawImage(os.path.join(qadir, "spike.png"), 20, yloc, width=500, height=133)
+    c.drawImage(get_image("spike.png"), 20, yloc, width=500, height=133)
     yloc = 330
-    images_to_draw = ["voxmean.png", "voxsfnr.png", "voxcv.png"]
-    imfiles = [os.path.join(qadir, t) for t in images_to_draw]
-    c.drawImage(imfiles[0], 0, yloc, width=300, height=300)
-    c.drawImage(imfiles[1], 300, yloc, width=300, height=300)
+    c.drawImage(get_image("voxmean.png"), 0, yloc, width=300, height=300)
+    c.drawImage(get_image("voxsfnr.png"), 300, yloc, width=300, height=300)
     yloc = 20
-    c.drawImage(imfiles[2], 0, yloc, width=325, height=325)
+    c.drawImage(get_image("voxcv.png"), 0, yloc, width=325, height=325)
 
     c.save()
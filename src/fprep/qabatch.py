@@ -0,0 +1,234 @@
+"""Run quality assurance for functional runs across a study."""
+
+import os
+import csv
+import argparse
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from fprep.subjutil import SubjPath
+
+# summary statistics saved for each run in qadata.csv
+qa_fields = ["SNR", "SFNR", "nspikes", "nscrub", "meanFD", "maxAJKZ"]
+
+
+def find_runs(subjects, study_dir, filename="bold_mcf.nii.gz"):
+    """Find functional runs with a QA input image for a set of subjects."""
+    runs = []
+    for subject in subjects:
+        sp = SubjPath(subject, study_dir)
+        if not os.path.exists(sp.path("bold")):
+            continue
+        for run_dir in sp.bold_dirs():
+            infile = os.path.join(run_dir, filename)
+            if os.path.exists(infile):
+                runs.append((subject, os.path.basename(run_dir), infile))
+    return runs
+
+
+def estimate_memory(infile, max_memory=None):
+    """
+    Estimate memory needed to run QA on an image, in MB.
+
+    If max_memory is set, QA will be run in chunks and the limit is
+    used as the estimate. Otherwise, the estimate is based on the image
+    dimensions in the header: the data in their stored type plus two
+    float64 copies used for voxel and spike statistics.
+    """
+    if max_memory is not None:
+        return max_memory
+
+    import numpy as np
+    from fprep import headers
+
+    info = headers.header_info(infile)
+    nbytes = 1
+    for n in info["shape"]:
+        nbytes *= n
+    itemsize = np.dtype(info["datatype"]).itemsize
+    return nbytes * (itemsize + 16) / 1024 ** 2
+
+
+def read_qadata(qadir):
+    """Read QA summary statistics for a run."""
+    values = {}
+    with open(os.path.join(qadir, "qadata.csv"), "r") as f:
+        for row in csv.reader(f):
+            if len(row) != 2:
+                continue
+            try:
+                values[row[0]] = int(row[1])
+            except ValueError:
+                values[row[0]] = float(row[1])
+    return values
+
+
+def tr_image(infile):
+    """
+    Image to read the TR of a run from.
+
+    As in prep_bold_run.sh, this is the raw bold.nii.gz in the run
+    directory if it exists, since motion correction may not preserve
+    the TR in the header.
+    """
+    raw = os.path.join(os.path.dirname(infile), "bold.nii.gz")
+    return raw if os.path.exists(raw) else infile
+
+
+def run_qa(infile, TR=None, qa_args=None):
+    """Run QA on one run and return its summary statistics."""
+    from fprep.fmriqa import fmriqa
+
+    if qa_args is None:
+        qa_args = {}
+    try:
+        qadir = fmriqa(infile, TR, tr_image=tr_image(infile), **qa_args)
+    except SystemExit:
+        # fmriqa exits on missing inputs
+        raise IOError("QA failed for %s; check for missing inputs." % infile)
+    return read_qadata(qadir)
+
+
+def run_batch(runs, n_workers=1, max_total_memory=None, qa_args=None, TR=None):
+    """
+    Run QA on multiple runs in a process pool.
+
+    Jobs are only started when their estimated memory fits within
+    max_total_memory (in MB) alongside the jobs already running; a job
+    that does not fit on its own is run by itself. If a worker dies (for
+    example, if it is killed for using too much memory), the pool cannot
+    start new jobs, and runs that have not started are marked as failed.
+    Returns a list of dicts with subject, run, status, and the QA
+    summary statistics.
+    """
+    if qa_args is None:
+        qa_args = {}
+    max_memory = qa_args.get("max_memory")
+
+    pending = [
+        (subject, run, infile, estimate_memory(infile, max_memory))
+        for subject, run, infile in runs
+    ]
+    results = []
+    running = {}
+    in_use = 0
+    with futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while pending or running:
+            # start jobs while workers and memory are available
+            i = 0
+            while i < len(pending) and len(running) < n_workers:
+                subject, run, infile, memory = pending[i]
+                fits = max_total_memory is None or in_use + memory <= max_total_memory
+                if fits or not running:
+                    try:
+                        future = executor.submit(run_qa, infile, TR, qa_args)
+                    except BrokenProcessPool as err:
+                        for subject, run, infile, memory in pending:
+                            res = {"subject": subject, "run": run}
+                            res["status"] = "failed: %s" % err
+                            print("%s %s: %s" % (subject, run, res["status"]))
+                            results.append(res)
+                        pending = []
+                        break
+                    running[future] = (subject, run, memory)
+                    in_use += memory
+                    del pending[i]
+                else:
+                    i += 1
+
+            if not running:
+                break
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                subject, run, memory = running.pop(future)
+                in_use -= memory
+                res = {"subject": subject, "run": run}
+                try:
+                    res.update(future.result())
+                    res["status"] = "ok"
+                except Exception as err:
+                    res["status"] = "failed: %s" % err
+                print("%s %s: %s" % (subject, run, res["status"]))
+                results.append(res)
+
+    results.sort(key=lambda x: (x["subject"], x["run"]))
+    return results
+
+
+def write_table(results, outfile):
+    """Write a study-level table of QA statistics."""
+    fieldnames = ["subject", "run"] + qa_fields + ["status"]
+    with open(outfile, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for res in results:
+            writer.writerow(res)
+
+
+def main():
+    from fprep import fmriqa
+
+    parser = argparse.ArgumentParser(
+        description="Run quality assurance on functional runs for many subjects."
+    )
+    parser.add_argument("subjects", nargs="+", help="subject directory names")
+    parser.add_argument(
+        "--study-dir",
+        default=os.environ.get("STUDYDIR"),
+        help="path to main study directory (default: STUDYDIR)",
+    )
+    parser.add_argument(
+        "--filename",
+        default="bold_mcf.nii.gz",
+        help="QA input image in each run directory (default: bold_mcf.nii.gz)",
+    )
+    parser.add_argument(
+        "--output", help="output table (default: [study-dir]/qa_summary.csv)"
+    )
+    parser.add_argument(
+        "--tr", type=float, help="repetition time (default: read from header)"
+    )
+    parser.add_argument(
+        "-n", "--workers", type=int, default=os.cpu_count(), help="number of workers"
+    )
+    parser.add_argument(
+        "--total-memory", type=float, help="memory budget for all workers (MB)"
+    )
+    parser.add_argument(
+        "--max-memory", type=int, help="run each job in chunks using this many MB"
+    )
+    parser.add_argument(
+        "--no-plot", action="store_true", help="skip figures and the PDF report"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="save time and memory use of each stage for each run",
+    )
+    parser.add_argument("--fd-thresh", type=float, default=fmriqa.FDthresh)
+    parser.add_argument("--dvars-thresh", type=float, default=fmriqa.DVARSthresh)
+    parser.add_argument("--ajkz-thresh", type=float, default=fmriqa.AJKZ_thresh)
+    parser.add_argument("--nback", type=int, default=fmriqa.nback)
+    parser.add_argument("--nforward", type=int, default=fmriqa.nforward)
+    args = parser.parse_args()
+
+    if args.study_dir is None:
+        raise ValueError("STUDYDIR not defined.")
+    output = args.output
+    if output is None:
+        output = os.path.join(args.study_dir, "qa_summary.csv")
+
+    qa_args = {
+        "plot_data": not args.no_plot,
+        "max_memory": args.max_memory,
+        "FDthresh": args.fd_thresh,
+        "DVARSthresh": args.dvars_thresh,
+        "AJKZ_thresh": args.ajkz_thresh,
+        "nback": args.nback,
+        "nforward": args.nforward,
+        "profile": args.profile,
+    }
+    runs = find_runs(args.subjects, args.study_dir, args.filename)
+    print("Found %d runs." % len(runs))
+    results = run_batch(runs, args.workers, args.total_memory, qa_args, args.tr)
+    write_table(results, output)
@@ -0,0 +1,190 @@
+"""Quality assurance for fMRI volumes as they are acquired."""
+
+import numpy as np
+from fprep import qa
+
+
+class StreamQA:
+    """
+    Incremental QA statistics for a functional run.
+
+    Volumes are added one at a time with their motion parameters. Each
+    update takes time proportional to the number of voxels. FD, DVARS,
+    voxel means and standard deviations, and brain mask statistics are
+    the same as calculated for the whole run at once.
+
+    The spike measure depends on a trend fit over the whole run. As each
+    volume is added, a live AJKZ is calculated from the fit to the
+    preceding volumes, so that a spike does not inflate the residual
+    variance it is compared to. If keep_data is True, brain voxel data
+    are kept so that summary() can calculate the exact AJKZ for the run
+    so far; this takes memory proportional to the length of the run.
+    """
+
+    def __init__(self, maskdata, order=1, keep_data=False):
+        maskvox = np.where(maskdata > 0)
+        slice_order = np.argsort(maskvox[2], kind="stable")
+        self.maskvox = tuple(ind[slice_order] for ind in maskvox)
+        self.nonmaskvox = np.where(maskdata == 0)
+        self.shape = maskdata.shape[:3]
+        self.order = order
+        self.keep_data = keep_data
+
+        nvox = len(self.maskvox[0])
+        self.ntp = 0
+        self.motpars = []
+        self.fd = []
+        self.dvars = []
+        self.live_ajkz = []
+        self.volstats = []
+        self.brain = []
+
+        # running voxel mean and sum of squared deviations
+        self.voxmean = np.zeros(self.shape)
+        self.voxm2 = np.zeros(self.shape)
+
+        # running trend fit: the Gram matrix of the polynomial design is
+        # shared by all voxels; each voxel has its own projections and sum
+        # of squares, relative to the first volume to limit round-off
+        self.gram = np.zeros((order + 1, order + 1))
+        self.proj = np.zeros((nvox, order + 1))
+        self.sumsq = np.zeros(nvox)
+        self.ref = None
+
+    def add_volume(self, vol, motpars):
+        """
+        Add a volume and its six motion parameters.
+
+        Returns a dict with FD, DVARS, and the maximum AJKZ over slices
+        for this volume.
+        """
+        vol = np.asarray(vol)
+        if vol.shape != self.shape:
+            raise ValueError(
+                "Volume shape %s does not match mask %s." % (vol.shape, self.shape)
+            )
+        motpars = np.asarray(motpars, dtype=np.float64)
+        t = self.ntp
+        self.ntp += 1
+
+        # framewise displacement relative to the previous volume
+        if t == 0:
+            fd = 0.0
+        else:
+            fd = qa.compute_fd(np.vstack((self.motpars[-1], motpars)))[1]
+        self.motpars.append(motpars)
+        self.fd.append(fd)
+
+        # voxel mean and variance
+        delta = vol - self.voxmean
+        self.voxmean += delta / self.ntp
+        self.voxm2 += delta * (vol - self.voxmean)
+
+        # brain mask statistics and DVARS
+        brain = vol[self.maskvox].astype(np.float64)
+        nonbrain = vol[self.nonmaskvox]
+        stats = qa.mask_stats(brain[:, None], nonbrain[:, None])
+        self.volstats.append(stats)
+        if t == 0:
+            dvars = 0.0
+        else:
+            prev = self.volstats[-2][2][0]
+            curr = stats[2][0]
+            dvars = np.sqrt(((curr - prev) / ((curr + prev) / 2.0)) ** 2) * 100.0
+        self.dvars.append(dvars)
+        if self.keep_data:
+            self.brain.append(brain)
+
+        # compare this volume to the trend fit so far, then update the fit
+        if self.ref is None:
+            self.ref = brain.copy()
+        diff = brain - self.ref
+        x = np.vander([float(t)], self.order + 1)[0]
+        ajkz = self.spike_measure(diff, x)
+        self.live_ajkz.append(ajkz)
+        self.gram += np.outer(x, x)
+        self.proj += diff[:, None] * x
+        self.sumsq += diff ** 2
+        return {"fd": fd, "dvars": dvars, "ajkz": np.max(ajkz)}
+
+    def spike_measure(self, brain, x):
+        """AJKZ for each slice of a volume, relative to the current fit."""
+        nslices = self.shape[2]
+        nfit = self.ntp - 1
+        if nfit <= self.order + 1:
+            # too few volumes to estimate residual variance
+            return np.full(nslices, np.nan)
+        coef = np.linalg.solve(self.gram, self.proj.T).T
+        rss = self.sumsq - np.sum(coef * self.proj, 1)
+        voxres = np.sqrt(np.maximum(rss, 0) / nfit)
+        # voxels with no residual variance have no Z-score
+        zscore = np.divide(
+            brain - coef @ x, voxres, out=np.zeros_like(brain), where=voxres > 0
+        )
+        AAZ = qa.slice_aaz(
+            zscore[:, None], self.maskvox[2], nslices, self.shape[0] * self.shape[1]
+        )
+        return np.abs(qa.jackknife_z(AAZ))[:, 0]
+
+    def summary(self):
+        """
+        Current QA statistics for the run.
+
+        Returns a dict with voxmean, voxstd, maskmedian, maskmad,
+        maskmean, maskcv, imgsnr, fd, DVARS, AJKZ, motpars, and meansfnr.
+        AJKZ is exact if data are kept; otherwise, it has the live
+        values calculated as each volume was added.
+        """
+        if self.ntp == 0:
+            raise ValueError("No volumes have been added.")
+
+        stats = {
+            "voxmean": self.voxmean.copy(),
+            "voxstd": np.sqrt(self.voxm2 / self.ntp),
+        }
+        names = ["maskmedian", "maskmad", "maskmean", "maskcv", "imgsnr"]
+        for name, values in zip(names, zip(*self.volstats)):
+            stats[name] = np.concatenate(values)
+        stats["fd"] = np.array(self.fd)
+        stats["DVARS"] = np.array(self.dvars)
+        stats["motpars"] = np.array(self.motpars)
+
+        if self.keep_data and self.ntp > 1:
+            brain = np.column_stack(self.brain)
+            zscore = qa.detrend_zscore(brain, self.order)
+            AAZ = qa.slice_aaz(
+                zscore,
+                self.maskvox[2],
+                self.shape[2],
+                self.shape[0] * self.shape[1],
+            )
+            stats["AJKZ"] = np.abs(qa.jackknife_z(AAZ))
+        else:
+            stats["AJKZ"] = np.column_stack(self.live_ajkz)
+
+        voxsfnr = stats["voxmean"] / stats["voxstd"]
+        stats["meansfnr"] = np.mean(voxsfnr[self.maskvox])
+        return stats
+
+
+def replay(infile, maskfile, motfile, keep_data=False, chunk_size=16):
+    """
+    Run streaming QA on a saved run, one volume at a time.
+
+    Volumes are read in order, chunk_size at a time, so that compressed
+    runs are decompressed once.
+    """
+    from fprep import image
+
+    img = image.load(infile)
+    maskdata = image.get_data(image.load(maskfile))
+    motpars = np.loadtxt(motfile)
+    stream = StreamQA(maskdata, keep_data=keep_data)
+    source = image.get_source(img)
+    ntp = img.shape[3]
+    for start in range(0, ntp, chunk_size):
+        finish = min(start + chunk_size, ntp)
+        chunk = image.read_volumes(source, start, finish, dtype=None)
+        for t in range(start, finish):
+            stream.add_volume(chunk[..., t - start], motpars[t])
+    return stream
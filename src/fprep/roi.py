@@ -0,0 +1,309 @@
+"""Regions of interest from FreeSurfer parcellations."""
+
+import os
+import shutil
+import argparse
+from concurrent import futures
+import numpy as np
+import nibabel as nib
+from fprep import image
+
+
+def labels(low, high=None):
+    """Voxels with labels in a range, as in fslmaths -thr low -uthr high -bin."""
+    return ("labels", float(low), float(low if high is None else high))
+
+
+def add(*args, binarize=False):
+    """Sum of ROIs and expressions, as in fslmaths -add."""
+    return ("add", args, binarize)
+
+
+def cortical(names):
+    """Left, right, and bilateral ROIs for FreeSurfer cortical labels."""
+    rois = {}
+    for no, name in names.items():
+        rois["l_" + name] = labels(1000 + no)
+        rois["r_" + name] = labels(2000 + no)
+        rois["b_" + name] = add("l_" + name, "r_" + name)
+    return rois
+
+
+# standard ROIs (formerly made by roi_freesurfer.sh)
+standard_rois = cortical(
+    {
+        6: "erc",  # entorhinal cortex
+        7: "fus",  # fusiform gyrus
+        9: "it",  # inferior temporal cortex
+        16: "phc",  # parahippocampal cortex
+        12: "lofc",  # lateral orbitofrontal cortex
+        11: "lo",  # lateral occipital
+        18: "oper",  # pars opercularis
+        20: "tria",  # pars triangularis
+        19: "orbi",  # pars orbitalis
+        14: "mofc",  # medial orbitofrontal cortex
+        32: "fropo",  # frontal pole
+        28: "sfg",  # superior frontal gyrus
+        27: "rmfg",  # rostral middle frontal gyrus
+        3: "cmfg",  # caudal middle frontal gyrus
+    }
+)
+standard_rois.update(
+    {
+        # hippocampus and ventral diencephalon
+        "l_hip": labels(17),
+        "r_hip": labels(53),
+        "b_hip": add("l_hip", "r_hip"),
+        "l_vidc": labels(28),
+        "r_vidc": labels(60),
+        "b_vidc": add("l_vidc", "r_vidc"),
+        # temporal pole (bilateral ROI is in the cortical set)
+        "l_tpo": labels(1033),
+        "r_tpo": labels(2033),
+        # all cortical and subcortical regions
+        "l_ctx": labels(1000, 1035),
+        "r_ctx": labels(2000, 2035),
+        "b_ctx": add("l_ctx", "r_ctx"),
+        "l_subco": add(labels(18), labels(9, 13), "l_hip", binarize=True),
+        "r_subco": labels(48, 54),
+        "b_subco": add("l_subco", "r_subco"),
+        "b_gray": add("b_subco", "b_ctx"),
+        # inferior frontal gyrus
+        "b_ifg": add("b_oper", "b_orbi", "b_tria"),
+        "l_ifg": add("l_oper", "l_orbi", "l_tria"),
+        "r_ifg": add("r_oper", "r_orbi", "r_tria"),
+        # temporal regions, with and without lateral occipital
+        "ostemporal": add("b_erc", "b_fus", "b_it", "b_phc"),
+        "ostemporal_lo": add("b_erc", "b_fus", "b_it", "b_phc", "b_lo"),
+    }
+)
+
+# all cortical ROIs (formerly made by croi_freesurfer.sh)
+cortical_rois = cortical(
+    {
+        2: "cac",
+        3: "cmf",
+        5: "cun",
+        6: "erc",
+        7: "fus",
+        8: "ip",
+        9: "it",
+        10: "imc",
+        11: "lo",
+        12: "lofc",
+        13: "ling",
+        14: "mofc",
+        15: "mt",
+        16: "phc",
+        17: "paracent",
+        18: "oper",
+        19: "orbi",
+        20: "tria",
+        21: "peric",
+        22: "postcent",
+        23: "pc",
+        24: "precent",
+        25: "precun",
+        26: "rac",
+        27: "rmf",
+        28: "sf",
+        29: "sp",
+        30: "st",
+        31: "supram",
+        32: "fpo",
+        33: "tpo",
+        34: "tt",
+        35: "insula",
+    }
+)
+
+roi_sets = {"standard": standard_rois, "cortical": cortical_rois}
+
+
+def read_lut(lut_file=None):
+    """Read names of cortical labels from a FreeSurfer color table."""
+    if lut_file is None:
+        if "FREESURFER_HOME" not in os.environ:
+            raise ValueError("FREESURFER_HOME not defined.")
+        lut_file = os.path.join(os.environ["FREESURFER_HOME"], "FreeSurferColorLUT.txt")
+    names = {}
+    with open(lut_file, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].isdigit():
+                continue
+            # left cortical labels are named ctx-lh-[name]
+            if fields[1].startswith("ctx-lh-"):
+                names[int(fields[0]) - 1000] = fields[1].split("-")[2]
+    return names
+
+
+class ROIMaker:
+    """
+    Make ROI masks from parcellation labels.
+
+    Labels are indexed by their unique values, so that each label range
+    is a lookup on the index. ROIs and the expressions they are made
+    from are calculated once, however many ROIs use them, and are kept
+    only until the last ROI that uses them has been made. Each ROI is
+    expected to be evaluated once. If labels is a list of unique labels,
+    ROIs give the value for each label.
+    """
+
+    def __init__(self, labels, rois, img=None):
+        labels = np.asarray(labels)
+        self.values, self.index = np.unique(labels, return_inverse=True)
+        self.index = self.index.reshape(labels.shape)
+        self.rois = rois
+        self.img = img
+        self.cache = {}
+        self.uses = {}
+        for name, expr in rois.items():
+            self.uses[name] = self.uses.get(name, 0) + 1
+            self.count_uses(expr)
+
+    def count_uses(self, expr):
+        """Count the uses of an expression and its arguments."""
+        self.uses[expr] = self.uses.get(expr, 0) + 1
+        if isinstance(expr, str):
+            # definitions of ROIs are counted once, with the ROI
+            return
+        if expr[0] == "add":
+            for arg in expr[1]:
+                self.count_uses(arg)
+
+    @classmethod
+    def from_file(cls, parcfile, rois):
+        """Make ROIs from a parcellation image file."""
+        img = image.load(parcfile)
+        return cls(image.get_data(img), rois, img)
+
+    def evaluate(self, expr):
+        """Values of an ROI or expression."""
+        key = expr
+        if key in self.cache:
+            result = self.cache[key]
+        elif isinstance(expr, str):
+            result = self.evaluate(self.rois[expr])
+        elif expr[0] == "labels":
+            low, high = expr[1:]
+            include = (self.values >= low) & (self.values <= high) & (self.values > 0)
+            result = include.astype(np.int16)[self.index]
+        elif expr[0] == "add":
+            args, binarize = expr[1:]
+            result = sum(self.evaluate(arg) for arg in args)
+            if binarize:
+                result = (result > 0).astype(np.int16)
+        else:
+            raise ValueError("Unknown ROI expression: %s" % (expr,))
+
+        # keep results until there are no remaining uses
+        self.uses[key] = self.uses.get(key, 0) - 1
+        if self.uses[key] > 0:
+            self.cache[key] = result
+        else:
+            self.cache.pop(key, None)
+        return result
+
+    def save(self, name, outfile, data=None):
+        """
+        Save an ROI in the data type of the parcellation.
+
+        If the ROI has already been evaluated, its values may be passed
+        as data.
+        """
+        if data is None:
+            data = self.evaluate(name)
+        header = self.img.header.copy()
+        data = data.astype(header.get_data_dtype())
+        nib.Nifti1Image(data, self.img.affine, header).to_filename(outfile)
+
+
+def make_rois(parcfile, out_dir, rois, n_workers=None):
+    """
+    Write masks for a set of ROIs.
+
+    A copy of the parcellation is saved as parcels.nii.gz. ROIs are
+    calculated in order and written in parallel, since compressing
+    images takes most of the time. Returns the paths to the ROI files.
+    """
+    if not os.path.exists(parcfile):
+        raise IOError("Input parcel file does not exist: %s" % parcfile)
+    if not os.path.isdir(out_dir):
+        raise IOError("Output directory does not exist: %s" % out_dir)
+
+    parcels = os.path.join(out_dir, "parcels.nii.gz")
+    if not os.path.exists(parcels) or not os.path.samefile(parcfile, parcels):
+        shutil.copyfile(parcfile, parcels)
+
+    maker = ROIMaker.from_file(parcfile, rois)
+    outfiles = {name: os.path.join(out_dir, name + ".nii.gz") for name in rois}
+    if n_workers is None:
+        n_workers = min(32, (os.cpu_count() or 1) + 4)
+    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # limit the masks waiting to be written, so that they are not
+        # all held in memory at once
+        pending = set()
+        for name, outfile in outfiles.items():
+            if len(pending) >= 2 * n_workers:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for job in done:
+                    job.result()
+            data = maker.evaluate(name)
+            pending.add(executor.submit(maker.save, name, outfile, data))
+        for job in futures.as_completed(pending):
+            job.result()
+    return list(outfiles.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create masks for standard ROIs based on FreeSurfer."
+    )
+    parser.add_argument("parcfile", help="path to FreeSurfer aparc+aseg file")
+    parser.add_argument("outdir", help="directory in which to save ROI files")
+    parser.add_argument(
+        "--set",
+        choices=list(roi_sets),
+        action="append",
+        help="ROI set to create (default: all sets)",
+    )
+    parser.add_argument(
+        "--cortical",
+        type=int,
+        action="append",
+        help="also create left, right, and bilateral ROIs for a cortical "
+        "label number, named from the FreeSurfer color table",
+    )
+    parser.add_argument(
+        "--lut",
+        help="FreeSurfer color table "
+        "(default: $FREESURFER_HOME/FreeSurferColorLUT.txt)",
+    )
+    parser.add_argument(
+        "-n", "--workers", type=int, help="number of files to write at once"
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="save the parcellation and all ROIs in a single file, "
+        "[outdir]/rois.npz, instead of individual masks",
+    )
+    args = parser.parse_args()
+
+    rois = {}
+    for name in args.set if args.set else roi_sets:
+        rois.update(roi_sets[name])
+    if args.cortical:
+        names = read_lut(args.lut)
+        rois.update(cortical({no: names[no] for no in args.cortical}))
+    if args.store:
+        from fprep import roistore
+
+        if not os.path.isdir(args.outdir):
+            raise IOError("Output directory does not exist: %s" % args.outdir)
+        roistore.write_store(args.parcfile, roistore.store_file(args.outdir), rois)
+    else:
+        make_rois(args.parcfile, args.outdir, rois, args.workers)
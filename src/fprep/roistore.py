@@ -0,0 +1,207 @@
+"""Store ROI masks for a parcellation in a single file."""
+
+import os
+import json
+import argparse
+from concurrent import futures
+import numpy as np
+import nibabel as nib
+from fprep import image
+from fprep import roi
+
+
+def store_file(out_dir):
+    """Path to the ROI store in a directory."""
+    return os.path.join(out_dir, "rois.npz")
+
+
+def roi_voxels(labels, rois):
+    """
+    Flat voxel indices and values of each ROI.
+
+    Voxels are sorted by label once, so that the voxels of each ROI are
+    gathered from the labels it includes. Values are None for ROIs that
+    are binary.
+    """
+    values, index = np.unique(labels, return_inverse=True)
+    index = index.ravel()
+    order = np.argsort(index, kind="stable")
+    bounds = np.searchsorted(index[order], np.arange(len(values) + 1))
+    dtype = np.int32 if index.size < 2 ** 31 else np.int64
+
+    maker = roi.ROIMaker(values, rois)
+    voxels = {}
+    for name in rois:
+        weight = maker.evaluate(name)
+        include = np.flatnonzero(weight)
+        blocks = [order[bounds[i] : bounds[i + 1]] for i in include]
+        indices = np.concatenate(blocks) if blocks else np.array([], dtype)
+        sort = np.argsort(indices, kind="stable")
+        if np.all(weight[include] == 1):
+            roi_values = None
+        else:
+            counts = bounds[include + 1] - bounds[include]
+            roi_values = np.repeat(weight[include], counts)[sort]
+        voxels[name] = (indices[sort].astype(dtype), roi_values)
+    return voxels
+
+
+def write_store(parcfile, outfile, rois):
+    """
+    Write a parcellation and its ROIs to a store file.
+
+    The store is an npz file with the label image, its affine and
+    header, the ROI definitions, and the voxel indices of each ROI in a
+    separate array, so that any ROI can be read without reading the
+    others.
+    """
+    if not os.path.exists(parcfile):
+        raise IOError("Input parcel file does not exist: %s" % parcfile)
+    img = image.load(parcfile)
+    header = nib.Nifti1Header.from_header(img.header)
+    labels = np.asarray(image.get_data(img))
+
+    arrays = {
+        "labels": labels,
+        "affine": img.affine,
+        "header": np.frombuffer(header.binaryblock, dtype=np.uint8),
+        "names": np.array(list(rois)),
+        "definitions": np.array(json.dumps(rois)),
+    }
+    for name, (indices, values) in roi_voxels(labels, rois).items():
+        arrays["indices/" + name] = indices
+        if values is not None:
+            arrays["values/" + name] = values
+
+    # write to a temporary file so that partial outputs are not left
+    temp_file = outfile + ".tmp.npz"
+    np.savez_compressed(temp_file, **arrays)
+    os.replace(temp_file, outfile)
+    return outfile
+
+
+class ROIStore:
+    """
+    Read ROIs from a store file.
+
+    Arrays are read from the file only when they are used, so getting
+    one ROI does not read the label image or the other ROIs.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.npz = np.load(filepath)
+        self.names = [str(name) for name in self.npz["names"]]
+        self.affine = self.npz["affine"]
+        self.header = nib.Nifti1Header(self.npz["header"].tobytes())
+        self.shape = self.header.get_data_shape()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def close(self):
+        """Close the store file."""
+        self.npz.close()
+
+    def definitions(self):
+        """Definitions of all ROIs in the store."""
+        return json.loads(str(self.npz["definitions"]))
+
+    def labels(self):
+        """Label image data."""
+        return self.npz["labels"]
+
+    def indices(self, name):
+        """Flat indices of the voxels in an ROI."""
+        if name not in self.names:
+            raise KeyError("ROI not in store: %s" % name)
+        return self.npz["indices/" + name]
+
+    def mask(self, name, dtype=None):
+        """ROI mask, in the data type of the label image by default."""
+        if dtype is None:
+            dtype = self.header.get_data_dtype()
+        indices = self.indices(name)
+        data = np.zeros(self.shape, dtype=dtype)
+        key = "values/" + name
+        data.reshape(-1)[indices] = self.npz[key] if key in self.npz.files else 1
+        return data
+
+    def image(self, name):
+        """ROI mask image."""
+        return nib.Nifti1Image(self.mask(name), self.affine, self.header.copy())
+
+    def save(self, name, outfile):
+        """Save an ROI mask to an image file."""
+        self.image(name).to_filename(outfile)
+
+    def label_image(self):
+        """Label image."""
+        return nib.Nifti1Image(self.labels(), self.affine, self.header.copy())
+
+    def export(self, out_dir, names=None, n_workers=None):
+        """
+        Write ROI masks to individual image files.
+
+        The label image is saved as parcels.nii.gz, as in make_rois.
+        Masks are made in order and written in parallel. Returns the
+        paths to the ROI files.
+        """
+        if not os.path.isdir(out_dir):
+            raise IOError("Output directory does not exist: %s" % out_dir)
+        if names is None:
+            names = self.names
+        parcels = os.path.join(out_dir, "parcels.nii.gz")
+        self.label_image().to_filename(parcels)
+
+        outfiles = {name: os.path.join(out_dir, name + ".nii.gz") for name in names}
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            jobs = [
+                executor.submit(self.save, name, outfile)
+                for name, outfile in outfiles.items()
+            ]
+            for job in jobs:
+                job.result()
+        return list(outfiles.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write ROI masks from an ROI store to individual files.",
+        epilog="ROI stores are made by fprep-roi --store.",
+    )
+    parser.add_argument("store", help="path to ROI store file")
+    parser.add_argument(
+        "outdir", nargs="?", help="directory in which to save ROI files"
+    )
+    parser.add_argument(
+        "--roi",
+        action="append",
+        help="ROI to export (default: all ROIs in the store)",
+    )
+    parser.add_argument(
+        "-n", "--workers", type=int, help="number of files to write at once"
+    )
+    parser.add_argument(
+        "-l", "--list", action="store_true", help="list ROIs in the store and exit"
+    )
+    args = parser.parse_args()
+
+    with ROIStore(args.store) as store:
+        if args.list:
+            for name in store.names:
+                print(name)
+            return
+        if args.outdir is None:
+            parser.error("outdir is required unless listing ROIs")
+        if args.roi:
+            missing = [name for name in args.roi if name not in store]
+            if missing:
+                parser.error("ROIs not in store: %s" % " ".join(missing))
+        store.export(args.outdir, args.roi, args.workers)
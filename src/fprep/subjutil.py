@@ -2,13 +2,30 @@
 
 import os
 import re
+import sys
+import math
 import time
+import json
+import fcntl
+import shlex
+import hashlib
+import tempfile
+import threading
 import subprocess as sub
+from concurrent import futures
 from datetime import datetime
 from glob import glob
 from argparse import ArgumentParser
-from pkg_resources import resource_filename
-import numpy as np
+from importlib import resources
+
+# environment variables that set the number of threads used by a command
+thread_vars = [
+    "FPREP_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+]
 
 
 def imname(filepath):
@@ -24,6 +41,132 @@ def impath(*args):
     return p
 
 
+def job_env(n_threads, env=None):
+    """Environment for a job that uses a given number of threads."""
+    if env is None:
+        env = os.environ
+    env = dict(env)
+    for var in thread_vars:
+        env[var] = str(n_threads)
+    return env
+
+
+def split_command(cmd):
+    """Get a command to run and its string representation."""
+    if isinstance(cmd, str):
+        return cmd, cmd
+    cmd = [str(arg) for arg in cmd]
+    return cmd, shlex.join(cmd)
+
+
+def file_state(filepath):
+    """Size and modification time of a file, or None if it is missing."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def command_fingerprint(cmd_str, inputs):
+    """Fingerprint of a command line and the current state of its inputs."""
+    h = hashlib.sha1(cmd_str.encode("utf-8"))
+    for filepath in sorted(inputs):
+        h.update(json.dumps([filepath, file_state(filepath)]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def command_tool(cmd_str):
+    """Name of the program run by a command."""
+    try:
+        args = shlex.split(cmd_str)
+    except ValueError:
+        args = cmd_str.split()
+    return os.path.basename(args[0]) if args else ""
+
+
+def input_size(inputs):
+    """Total size of existing input files in MB."""
+    states = [file_state(f) for f in inputs]
+    return sum(st[0] for st in states if st is not None) / 1024 ** 2
+
+
+def estimate_usage(records, inputs_mb=None, n_nearest=5):
+    """
+    Estimate time and memory of a command from previous runs.
+
+    Records are usage records from runs of the same program. If the
+    input size is known, the runs with the most similar input sizes are
+    used. Returns the median wall time and maximum peak memory of those
+    runs, or None if there are no records.
+    """
+    if not records:
+        return None
+    if inputs_mb is not None:
+        sized = [r for r in records if r.get("input_mb") is not None]
+        if sized:
+            # compare sizes on a log scale
+            def distance(r):
+                return abs(math.log1p(r["input_mb"]) - math.log1p(inputs_mb))
+
+            records = sorted(sized, key=distance)[:n_nearest]
+    wall = sorted(r["wall_s"] for r in records)
+    maxrss = [r["maxrss_mb"] for r in records if r.get("maxrss_mb") is not None]
+    return {
+        "wall_s": wall[len(wall) // 2],
+        "maxrss_mb": max(maxrss) if maxrss else None,
+        "n_runs": len(records),
+    }
+
+
+def abspaths(files):
+    """Set of absolute paths to a list of files."""
+    return set(os.path.abspath(f) for f in (files or []))
+
+
+def read_proc_io(pid):
+    """Read I/O counters for a process from /proc, if available."""
+    counters = {}
+    try:
+        with open("/proc/%d/io" % pid, "r") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def wait_usage(p):
+    """
+    Wait for a process and get its resource usage.
+
+    Usage includes any child processes that it waited for. Returns the
+    exit code and a dict with user and system CPU time, peak resident
+    set size, and (on Linux) bytes read and written.
+    """
+    io = {}
+    if hasattr(os, "waitid"):
+        # wait without reaping, so that /proc/<pid>/io is still available
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(p.pid)
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    # maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = rusage.ru_maxrss / 1024
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    usage = {
+        "user_s": rusage.ru_utime,
+        "sys_s": rusage.ru_stime,
+        "maxrss_mb": maxrss,
+    }
+    for name in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+        usage[name] = io.get(name)
+    return p.returncode, usage
+
+
 class SubjParser(ArgumentParser):
     """Class for parsing standard arguments."""
 
@@ -54,26 +197,71 @@ environment variable will be used"""
                 default=False,
                 action="store_true",
             )
+            self.add_argument(
+                "--plan",
+                metavar="FILE",
+                help="write a JSON plan of commands with estimated time and "
+                "memory to FILE, without executing (implies --dry-run)",
+            )
             self.add_argument(
                 "--clean-logs",
                 help="remove existing similar logs",
                 default=False,
                 action="store_true",
             )
+            self.add_argument(
+                "--incremental",
+                help="skip commands whose outputs are up to date",
+                default=False,
+                action="store_true",
+            )
+            self.add_argument(
+                "--threads",
+                type=int,
+                help="number of threads to use, where supported; sets how many "
+                "commands run at once and the thread variables (ITK, OpenMP, "
+                "BLAS) of each command (default: FPREP_THREADS, or number "
+                "of CPUs without limiting command threads)",
+            )
 
 
 class SubjLog:
     """Class for logging subject processing."""
 
     def __init__(
-        self, subject, base, main=None, rm_existing=False, dry_run=False, study_dir=None
+        self,
+        subject,
+        base,
+        main=None,
+        rm_existing=False,
+        dry_run=False,
+        study_dir=None,
+        n_threads=None,
+        incremental=False,
+        plan_file=None,
     ):
 
         self.subject = subject
         self.name = base
-        self.dry_run = dry_run
+        self.plan_file = plan_file
+        self.dry_run = dry_run or plan_file is not None
+        self.plan = []
+        self.stale_outputs = set()
+        self.history = None
         self.main_file = None
         self.start_time = None
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.queue = []
+        # a budget set with --threads or FPREP_THREADS also limits the
+        # threads of each command that is run directly
+        if n_threads is None and "FPREP_THREADS" in os.environ:
+            n_threads = int(os.environ["FPREP_THREADS"])
+        self.thread_budget = max(n_threads, 1) if n_threads is not None else None
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        self.n_threads = max(n_threads, 1)
+        self.incremental = incremental
 
         # set the log file
         if study_dir is None:
@@ -81,6 +269,7 @@ class SubjLog:
                 study_dir = os.environ["STUDYDIR"]
             else:
                 raise ValueError("STUDYDIR not defined.")
+        self.study_dir = study_dir
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         filename = base + "_" + timestamp + ".log"
         log_dir = os.path.join(study_dir, subject, "logs")
@@ -94,17 +283,23 @@ class SubjLog:
         if rm_existing:
             # clear logs that match the supplied base
             existing = glob(os.path.join(log_dir, "%s_*.log" % base))
+            existing += glob(os.path.join(log_dir, "%s_*.jsonl" % base))
             for filepath in existing:
                 os.remove(filepath)
         self.log_file = log_file
 
+        # resource usage of each command, one JSON record per line
+        self.usage_file = os.path.splitext(log_file)[0] + ".jsonl"
+
+        # fingerprints of commands that have completed, shared by all
+        # scripts run for this subject
+        self.state_file = os.path.join(log_dir, "incremental.json")
+        self.state = None
+
     def get_logo(self):
         """Get the text logo for fPrep."""
-        logo_file = resource_filename("fprep", "data/fprep_logo.txt")
-        with open(logo_file, "r") as f:
-            logo = f.read()
-        f.close()
-        return logo
+        logo_file = resources.files("fprep").joinpath("data").joinpath("fprep_logo.txt")
+        return logo_file.read_text()
 
     def timestamp(self):
         """Get a timestamp with standard formatting for a log."""
@@ -131,7 +326,10 @@ class SubjLog:
     def finish(self):
         """Finish and close the log."""
 
+        self.run_queue()
         if self.dry_run:
+            if self.plan_file is not None:
+                self.write_plan()
             return
 
         finish = time.time() - self.start_time
@@ -144,32 +342,436 @@ class SubjLog:
         self.write("Took %d s." % finish, wrap=False)
         if self.main_file:
             self.write(msg, wrap=False, main_log=True)
+        self.close()
+
+    def handle(self, main_log=False, usage=False):
+        """Get an open handle to the log file."""
+        if usage:
+            filepath = self.usage_file
+        elif main_log:
+            filepath = self.main_file
+        else:
+            filepath = self.log_file
+        if filepath not in self.handles:
+            self.handles[filepath] = open(filepath, "a")
+        return self.handles[filepath]
+
+    def close(self):
+        """Close open log files."""
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+
+    def stream(self, pipe, outfile, console=None, prefix="", console_prefix=""):
+        """Copy lines from a pipe to the log and console as they arrive."""
+        # read with a limit so that long lines without a newline (e.g.,
+        # progress bars) do not accumulate in memory
+        for line in iter(lambda: pipe.readline(65536), ""):
+            with self.lock:
+                outfile.write(prefix + line)
+                if console is not None:
+                    console.write(console_prefix + prefix + line)
+                    console.flush()
+        pipe.close()
+
+    def execute(self, cmd, cmd_str, outfile, console=None, inputs=None, threads=None):
+        """
+        Run a command and copy its output; return exit code and usage.
+
+        If threads is set, the command is limited to that many threads
+        through ITK, OpenMP, and BLAS environment variables.
+        """
+        inputs_mb = input_size(inputs) if inputs else None
+        env = job_env(threads) if threads is not None else None
+        start = time.time()
+        try:
+            p = sub.Popen(
+                cmd,
+                stdout=sub.PIPE,
+                stderr=sub.PIPE,
+                shell=isinstance(cmd, str),
+                env=env,
+                universal_newlines=True,
+                errors="replace",
+            )
+        except OSError as err:
+            # log a missing program as an error and continue, as when a
+            # shell cannot find a command
+            with self.lock:
+                outfile.write("ERROR: %s\n" % err)
+                if console is not None:
+                    console.write("%s: ERROR: %s\n" % (self.subject, err))
+                    console.flush()
+            returncode, usage = 127, {}
+        else:
+            err_thread = threading.Thread(
+                target=self.stream,
+                args=(p.stderr, outfile, console, "ERROR: ", "%s: " % self.subject),
+            )
+            err_thread.start()
+            self.stream(p.stdout, outfile, console)
+            err_thread.join()
+            returncode, usage = wait_usage(p)
+        outfile.flush()
+
+        record = {
+            "command": cmd_str,
+            "start": datetime.fromtimestamp(start).isoformat(timespec="seconds"),
+            "wall_s": time.time() - start,
+            "input_mb": inputs_mb,
+        }
+        record.update(usage)
+        record["exit_code"] = returncode
+        return returncode, record
+
+    def write_usage(self, record):
+        """Write a command resource usage record."""
+        usage_file = self.handle(usage=True)
+        usage_file.write(json.dumps(record) + "\n")
+        usage_file.flush()
+
+    def read_state(self):
+        """Read fingerprints of completed commands from the state file."""
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file, "r") as f:
+            return json.load(f)
+
+    def load_state(self):
+        """Load fingerprints of completed commands."""
+        if self.state is None:
+            self.state = self.read_state()
+        return self.state
+
+    def is_current(self, cmd_str, inputs, outputs):
+        """Check whether a command's outputs are up to date."""
+        if not self.incremental or not outputs:
+            return False
+        if not all(os.path.exists(f) for f in outputs):
+            return False
+        if inputs & self.stale_outputs:
+            # in a dry run, an input will be remade by an earlier command
+            return False
+        stored = self.load_state().get(cmd_str)
+        return stored == command_fingerprint(cmd_str, inputs)
+
+    def update_state(self, cmd_str, inputs, outputs, returncode):
+        """
+        Record the fingerprint of a command after it has run.
+
+        Other scripts may be updating the state file for the same
+        subject, so the file is locked and read again before the change
+        is merged and written.
+        """
+        if not outputs:
+            return
+        if returncode == 0:
+            # take input state after running, so that commands that
+            # modify a file in place are current on the next run
+            fingerprint = command_fingerprint(cmd_str, inputs)
+        with open(self.state_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.read_state()
+            if returncode == 0:
+                state[cmd_str] = fingerprint
+            else:
+                state.pop(cmd_str, None)
+            temp_file = "%s.%d.tmp" % (self.state_file, os.getpid())
+            with open(temp_file, "w") as f:
+                json.dump(state, f, indent=1)
+            os.replace(temp_file, self.state_file)
+        self.state = state
+
+    def write_skipped(self, cmd_str):
+        """Log that a command was skipped."""
+        print(cmd_str)
+        print("Skipped: outputs are up to date.")
+        if self.dry_run:
+            return
+        outfile = self.handle()
+        outfile.write("\n" + cmd_str + "\nSkipped: outputs are up to date.\n")
+        outfile.flush()
+
+    def run(self, cmd, inputs=None, outputs=None):
+        """
+        Run a command with input and output logging.
+
+        The command may be a string, which is run in a shell, or a list of
+        arguments, which is run directly. Output is written to the log and
+        console line by line while the command runs; lines written to
+        standard error are marked as errors. Time, CPU, memory, and I/O
+        used by the command are recorded in the usage file. If a thread
+        budget was set (with --threads or FPREP_THREADS), the command is
+        limited to that many threads; otherwise, it runs in the caller's
+        environment. Returns the exit code, which is
+        0 if the command was skipped or this is a dry run, and 127 if the
+        program could not be started.
+
+        Inputs and outputs are the files that the command reads and
+        writes. In incremental mode, the command is skipped if its outputs
+        exist and neither the command line nor its inputs have changed
+        since it last ran successfully.
+
+        Any submitted commands are run first.
+        """
+
+        self.run_queue()
+        cmd, cmd_str = split_command(cmd)
+        inputs = abspaths(inputs)
+        outputs = abspaths(outputs)
+        if self.is_current(cmd_str, inputs, outputs):
+            self.write_skipped(cmd_str)
+            if self.dry_run:
+                self.add_plan(cmd_str, inputs, outputs, current=True)
+            return 0
+
+        print(cmd_str)
+        if self.dry_run:
+            self.add_plan(cmd_str, inputs, outputs)
+            return 0
+
+        # print command to run
+        outfile = self.handle()
+        outfile.write("\n" + cmd_str + "\n")
+        outfile.flush()
+        returncode, record = self.execute(
+            cmd, cmd_str, outfile, sys.stdout, inputs, self.thread_budget
+        )
+        self.write_usage(record)
+        self.update_state(cmd_str, inputs, outputs, returncode)
+        return returncode
+
+    def submit(self, cmd, inputs=None, outputs=None, threads=1):
+        """
+        Add a command to the queue to run concurrently with others.
+
+        Inputs and outputs are the files that the command reads and
+        writes. A command waits for earlier commands that write its
+        inputs, or that read or write its outputs. Commands run when
+        run_queue is called, or before the next command that is run
+        directly. In incremental mode, commands with up-to-date outputs
+        are skipped, as in run.
+
+        Threads is the number of threads the command uses. It counts
+        against n_threads when scheduling, and the command is limited to
+        it through ITK, OpenMP, and BLAS environment variables.
+        """
+        cmd, cmd_str = split_command(cmd)
+        inputs = abspaths(inputs)
+        outputs = abspaths(outputs)
+        deps = set()
+        for i, job in enumerate(self.queue):
+            reads = inputs & job["outputs"]
+            writes = outputs & (job["inputs"] | job["outputs"])
+            if reads or writes:
+                deps.add(i)
+        self.queue.append(
+            {
+                "cmd": cmd,
+                "cmd_str": cmd_str,
+                "inputs": inputs,
+                "outputs": outputs,
+                "threads": min(threads, self.n_threads),
+                "deps": deps,
+            }
+        )
 
-    def run(self, cmd):
-        """Run a command with input and output logging."""
+    def run_queue(self):
+        """
+        Run submitted commands, using up to n_threads at a time.
+
+        Output from each command is collected while it runs and written to
+        the log in the order the commands were submitted. In a dry run,
+        the plan is printed instead.
+        """
+        queue = self.queue
+        self.queue = []
+        if not queue:
+            return
 
-        print(cmd)
         if self.dry_run:
+            start = len(self.plan)
+            for i, job in enumerate(queue):
+                print("[%d] %s" % (i + 1, job["cmd_str"]))
+                if job["deps"]:
+                    after = ", ".join(str(d + 1) for d in sorted(job["deps"]))
+                    print("    after: %s" % after)
+                current = self.is_current(job["cmd_str"], job["inputs"], job["outputs"])
+                if current:
+                    print("    up to date")
+                self.add_plan(
+                    job["cmd_str"],
+                    job["inputs"],
+                    job["outputs"],
+                    current,
+                    job["threads"],
+                    [start + d for d in sorted(job["deps"])],
+                )
+            return
+
+        pending = list(range(len(queue)))
+        running = {}
+        done = set()
+        results = {}
+        n_written = 0
+        in_use = 0
+        with futures.ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            while pending or running:
+                # start commands with completed dependencies while threads
+                # are available
+                for i in list(pending):
+                    job = queue[i]
+                    if not job["deps"] <= done:
+                        continue
+                    if self.is_current(job["cmd_str"], job["inputs"], job["outputs"]):
+                        done.add(i)
+                        results[i] = None
+                        pending.remove(i)
+                        continue
+                    if running and in_use + job["threads"] > self.n_threads:
+                        continue
+                    spool = tempfile.SpooledTemporaryFile(max_size=2 ** 20, mode="w+")
+                    future = executor.submit(
+                        self.execute,
+                        job["cmd"],
+                        job["cmd_str"],
+                        spool,
+                        None,
+                        job["inputs"],
+                        job["threads"],
+                    )
+                    running[future] = (i, spool)
+                    in_use += job["threads"]
+                    pending.remove(i)
+
+                finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    i, spool = running.pop(future)
+                    job = queue[i]
+                    in_use -= job["threads"]
+                    done.add(i)
+                    returncode, record = future.result()
+                    self.update_state(
+                        job["cmd_str"], job["inputs"], job["outputs"], returncode
+                    )
+                    results[i] = (spool, record)
+
+                # write output of finished commands in order
+                while n_written in results:
+                    result = results.pop(n_written)
+                    cmd_str = queue[n_written]["cmd_str"]
+                    if result is None:
+                        self.write_skipped(cmd_str)
+                    else:
+                        self.write_spool(cmd_str, result[0])
+                        self.write_usage(result[1])
+                    n_written += 1
+
+    def load_history(self):
+        """Load usage records of commands run for all subjects in the study."""
+        if self.history is None:
+            self.history = {}
+            pattern = os.path.join(self.study_dir, "*", "logs", "*.jsonl")
+            for usage_file in glob(pattern):
+                with open(usage_file, "r") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # partial line from an interrupted run
+                            continue
+                        if record.get("exit_code") != 0:
+                            continue
+                        tool = command_tool(record["command"])
+                        self.history.setdefault(tool, []).append(record)
+        return self.history
+
+    def add_plan(self, cmd_str, inputs, outputs, current=False, threads=1, after=None):
+        """Add a command to the dry-run plan."""
+        if not current:
+            # commands that use these outputs will also need to run
+            self.stale_outputs.update(outputs)
+        if self.plan_file is None:
             return
+        tool = command_tool(cmd_str)
+        inputs_mb = None
+        if inputs and all(os.path.exists(f) for f in inputs):
+            # size is unknown if inputs will be made by earlier commands
+            inputs_mb = input_size(inputs)
+        estimate = None
+        if not current:
+            estimate = estimate_usage(self.load_history().get(tool), inputs_mb)
+        self.plan.append(
+            {
+                "command": cmd_str,
+                "tool": tool,
+                "inputs": [
+                    {"path": f, "exists": os.path.exists(f)} for f in sorted(inputs)
+                ],
+                "outputs": [
+                    {"path": f, "exists": os.path.exists(f)} for f in sorted(outputs)
+                ],
+                "input_mb": inputs_mb,
+                "up_to_date": current,
+                "threads": threads,
+                "after": [] if after is None else after,
+                "estimate": estimate,
+            }
+        )
 
-        # open log file and print command to run
-        outfile = open(self.log_file, "a")
-        outfile.write("\n" + cmd + "\n")
-        outfile.close()
-
-        # actually running the command
-        p = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.PIPE, shell=True)
-        output, errors = p.communicate()
-        outfile = open(self.log_file, "a")
-        if output:
-            output = output.decode('utf-8')
-            print(output)
-            outfile.write(output)
-        if errors:
-            errors = errors.decode('utf-8')
-            outfile.write("ERROR: " + errors)
-            print("%s: ERROR: " % self.subject + errors)
-        outfile.close()
+    def write_plan(self):
+        """
+        Write the dry-run plan to a JSON file.
+
+        Totals include commands that are not up to date. Commands with no
+        previous runs of the same program are counted in n_unestimated.
+        """
+        wall = 0
+        core = 0
+        maxrss = 0
+        n_unestimated = 0
+        for entry in self.plan:
+            if entry["up_to_date"]:
+                continue
+            estimate = entry["estimate"]
+            if estimate is None:
+                n_unestimated += 1
+                continue
+            wall += estimate["wall_s"]
+            core += estimate["wall_s"] * entry["threads"]
+            if estimate["maxrss_mb"] is not None:
+                maxrss = max(maxrss, estimate["maxrss_mb"])
+        plan = {
+            "subject": self.subject,
+            "name": self.name,
+            "created": self.timestamp(),
+            "commands": self.plan,
+            "total": {
+                "wall_s": wall,
+                "core_hours": core / 3600,
+                "maxrss_mb": maxrss,
+                "n_commands": len(self.plan),
+                "n_unestimated": n_unestimated,
+            },
+        }
+        with open(self.plan_file, "w") as f:
+            json.dump(plan, f, indent=2)
+
+    def write_spool(self, cmd_str, spool):
+        """Copy collected output of a command to the log and console."""
+        print(cmd_str)
+        outfile = self.handle()
+        spool.seek(0)
+        outfile.write("\n" + cmd_str + "\n")
+        for line in iter(lambda: spool.readline(65536), ""):
+            outfile.write(line)
+            if line.startswith("ERROR: "):
+                sys.stdout.write("%s: " % self.subject + line)
+            else:
+                sys.stdout.write(line)
+        spool.close()
+        outfile.flush()
+        sys.stdout.flush()
 
     def write(self, message, wrap=True, main_log=False):
         """Write a message to the log."""
@@ -178,17 +780,14 @@ class SubjLog:
             print(message)
             return
 
-        if main_log:
-            outfile = open(self.main_file, "a")
-        else:
-            outfile = open(self.log_file, "a")
+        outfile = self.handle(main_log)
         if isinstance(message, bytes):
             message = message.decode('utf-8')
         if wrap:
             outfile.write("\nMESSAGE: " + message + "\n")
         else:
             outfile.write(message)
-        outfile.close()
+        outfile.flush()
 
 
 class SubjPath:
@@ -324,21 +923,19 @@ class SubjPath:
         if len(files) < 2:
             return
 
-        # get the number of volumes for each scan in this task
-        n_vols = []
-        for f in files:
-            cmd = 'fslinfo %s | grep "^dim4" | tr -s " " | cut -d " " -f 2' % f
-            p = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.PIPE, shell=True)
-            output, errors = p.communicate()
-            n_vols.append(int(output))
+        # get the number of volumes for each scan in this task, reading
+        # only the image headers
+        from fprep import headers
+
+        n_vols = [info["n_volumes"] for info in headers.get_info(files)]
 
         # delete short runs
-        isshort = n_vols < np.max(n_vols)
-        if np.any(isshort):
-            ind = np.nonzero(isshort)[0]
-            for i in ind:
-                log.run("rm %s" % files[i])
-                parent = os.path.dirname(files[i])
+        max_vols = max(n_vols)
+        short = [f for f, n in zip(files, n_vols) if n < max_vols]
+        if short:
+            for f in short:
+                log.run("rm %s" % f)
+                parent = os.path.dirname(f)
                 log.run("rmdir %s" % parent)
         else:
             log.write("%s: no short runs found." % task)
@@ -357,5 +954,8 @@ class SubjPath:
             rm_existing=args.clean_logs,
             dry_run=args.dry_run,
             study_dir=args.study_dir,
+            n_threads=getattr(args, "threads", None),
+            incremental=getattr(args, "incremental", False),
+            plan_file=getattr(args, "plan", None),
         )
         return log